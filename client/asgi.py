@@ -0,0 +1,72 @@
+"""
+ASGI config for client project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Run it with an ASGI server, e.g. ``uvicorn client.asgi:application --port 8031``.
+"""
+
+import asyncio
+import contextvars
+import os
+
+import django
+from django.core.handlers.asgi import ASGIHandler
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "client.settings")
+
+_receive = contextvars.ContextVar('receive')
+
+
+async def wait_for_disconnect(receive):
+    # the request body is already read, the next message can only be the disconnect
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class ClientASGIHandler(ASGIHandler):
+    # search and transfer views are async here, see client/asgi_urls.py
+    def __init__(self, start_index=False):
+        super().__init__()
+        # only the served application builds the name index, not handlers created by the benchmark
+        self.start_index = start_index
+
+    async def __call__(self, scope, receive, send):
+        if self.start_index:
+            name_index.start()
+        _receive.set(receive)
+        await super().__call__(scope, receive, send)
+
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None:
+            request.urlconf = 'client.asgi_urls'
+        return request, error_response
+
+    async def send_response(self, response, send):
+        # Django before 4.2 iterates streamed bodies synchronously, async_streaming_content is sent here
+        chunks = getattr(response, 'async_streaming_content', None)
+        if chunks is None:
+            return await super().send_response(response, send)
+        disconnect = asyncio.ensure_future(wait_for_disconnect(_receive.get()))
+
+        async def send_with_chunks(message):
+            # the async body goes before the closing message of the empty sync one
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                async for chunk in chunks:
+                    if disconnect.done():
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send(message)
+
+        try:
+            await super().send_response(response, send_with_chunks)
+        finally:
+            disconnect.cancel()
+            await chunks.aclose()
+
+
+django.setup(set_prefix=False)
+application = ClientASGIHandler(start_index=True)
+
+# needs the apps loaded
+from client_app import name_index
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'client_app.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,6 +89,23 @@ DATABASES = {
 }
 
 
+# Cache
+# 'outer' keeps answers of the server and other clients for a short time
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'outer': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'outer',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -132,4 +150,114 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 SERVER_PORT = '8030'
 CLIENT_PORT = '8031'
 
+# Outgoing HTTP connections to the server and other clients, timeouts are in seconds
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_READ_TIMEOUT = 30
+HTTP_POOL_CONNECTIONS = 32
+HTTP_POOL_MAXSIZE = 16
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.5
+
+# Searching other clients, timeouts are in seconds
+PEER_CONNECT_TIMEOUT = 3
+PEER_READ_TIMEOUT = 10
+PEER_SEARCH_DEADLINE = 15
+PEER_SEARCH_WORKERS = 16
+PEER_SEARCH_LIMIT = 100
+ONLINE_CACHE_TTL = 10
+PEER_SEARCH_CACHE_TTL = 30
+
+# Serving files: None sends them from Django (sendfile when the WSGI server supports it),
+# 'x-accel' or 'x-sendfile' hands them to nginx or apache/lighttpd in front of it
+FILE_SERVE_MODE = None
+FILE_SERVE_ACCEL_PREFIX = '/protected'
+FILE_SERVE_BLOCK_SIZE = 1024 * 1024
+
+# Loading files from other clients
+DOWNLOAD_PART_DIR = os.path.join(BASE_DIR, 'downloads')
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_MAX_ACTIVE = 3
+DOWNLOAD_MAX_PER_PEER = 1
+DOWNLOAD_RETRY_DELAY = 5
+# a running download marks itself alive every DOWNLOAD_HEARTBEAT seconds, one silent for DOWNLOAD_STALE_AFTER
+# lost its worker and is shown as failed, so it can be retried
+DOWNLOAD_HEARTBEAT = 30
+DOWNLOAD_STALE_AFTER = 120
+
+# Bandwidth limits in bytes per second, 0 - no limit
+DOWNLOAD_RATE_LIMIT = 0
+UPLOAD_RATE_LIMIT = 0
+
+# Loading one file from several clients at once, piece by piece
+SWARM_PIECE_SIZE = 4 * 1024 * 1024
+SWARM_WORKERS = 8
+SWARM_PIECE_TIMEOUT = 60
+SWARM_MAX_PEER_FAILURES = 3
+# other clients hash the pieces in the background on the first /pieces request (202 until then),
+# a download asks again every SWARM_PIECES_POLL seconds for up to SWARM_PIECES_WAIT before loading from one client
+SWARM_PIECES_WAIT = 60
+SWARM_PIECES_POLL = 2
+
+# Answering searches of other clients
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 1000
+# hashes in one POST /hashes, a longer list is sent in several requests
+HASH_LOOKUP_MAX = 10000
+# Answer them from an in-memory index of shared file names instead of the database,
+# it is built when the web server starts and reloads changed storages every NAME_INDEX_REFRESH seconds
+NAME_INDEX_ENABLED = False
+NAME_INDEX_REFRESH = 2
+
+# /summary: a bloom filter of name trigrams and hashes of shared files, other clients skip searches it rules out
+SUMMARY_FALSE_POSITIVE_RATE = 0.01
+SUMMARY_MAX_BYTES = 4 * 1024 * 1024
+# A peer is skipped only after asking whether its summary changed (304 if not), so files shared since are never
+# missed. That check runs alongside the searches of the other peers, a peer the summary cannot rule out is asked
+# at once. With SUMMARY_REFRESH > 0 a summary is trusted that many seconds without the check, at the price of
+# missing files the peer shared meanwhile. A client without /summary is asked again after SUMMARY_MISSING_REFRESH,
+# it is searched every time until then.
+SUMMARY_REFRESH = 0
+SUMMARY_MISSING_REFRESH = 60
+
+# Background tasks: run ping and storage scans side by side, scans of big storages take long
+BACKGROUND_TASK_RUN_ASYNC = True
+MAX_RUN_TIME = 24 * 60 * 60
+
+# File hashing
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+HASH_USE_PROCESSES = False
+HASH_USE_MMAP = False
+# days a cached hash is kept without being looked up
+HASH_CACHE_MAX_AGE = 90
+# cached hashes kept at most, the table is counted once per HASH_CACHE_COUNT_EVERY evictions where postgres
+# planner statistics are not available
+HASH_CACHE_MAX_ENTRIES = 5000000
+HASH_CACHE_COUNT_EVERY = 20
+
+# manage.py heartbeat, seconds between pings of the server and the longest pause while it is unreachable
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_MAX_BACKOFF = 60
+HEARTBEAT_JITTER = 0.1
+# milliseconds the ping latency has to move before it is stored again
+HEARTBEAT_LATENCY_STEP = 20
+
+# Every process dumps its metrics here for /metrics, None keeps them in the web server process only
+METRICS_DIR = os.path.join(BASE_DIR, 'metrics')
+METRICS_DUMP_INTERVAL = 5
+# /metrics answers these addresses without a login, e.g. a Prometheus on the same host. Requests with
+# X-Forwarded-For, X-Real-IP or Forwarded headers need a login: behind nginx they all come from 127.0.0.1
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# requests to other clients and the server slower than this are logged with their address
+PEER_SLOW_SECONDS = 2
+
+# Seconds a process keeps the Settings table in memory
+SETTINGS_CACHE_TTL = 5
+
+# Live indexing by manage.py watch_storages, a path is indexed after WATCH_DEBOUNCE quiet seconds
+WATCH_DEBOUNCE = 2
+WATCH_BATCH_SIZE = 100
+WATCH_STORAGE_REFRESH = 30
+
 LOGIN_URL = '/auth'
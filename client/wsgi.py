@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "client.settings")
 
 application = get_wsgi_application()
+
+# needs the apps loaded
+from client_app import name_index
+
+name_index.start()
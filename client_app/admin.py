@@ -1,8 +1,12 @@
 from django.contrib import admin
 
 # Register your models here.
-from client_app.models import File, Storage, Settings
+from client_app.models import File, Storage, Settings, StorageScan, HashCache, PieceHashes, Transfer
 
 admin.site.register(File)
 admin.site.register(Storage)
 admin.site.register(Settings)
+admin.site.register(StorageScan)
+admin.site.register(HashCache)
+admin.site.register(PieceHashes)
+admin.site.register(Transfer)
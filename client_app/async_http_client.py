@@ -0,0 +1,21 @@
+import asyncio
+import weakref
+
+import httpx
+
+from client.settings import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_POOL_MAXSIZE
+
+# httpx clients are bound to the event loop they were created in
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    # one keep-alive client per event loop, the number of open transfers is not limited
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=HTTP_POOL_MAXSIZE),
+        )
+    return client
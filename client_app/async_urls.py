@@ -0,0 +1,18 @@
+from django.urls import path
+
+from client_app import async_views
+from client_app.urls import urlpatterns as sync_urlpatterns
+
+# under ASGI the views waiting on the network or the disk run on the event loop, the rest stay the same
+async_views_by_name = {
+    'search_file': async_views.search_file,
+    'outer_files': async_views.search_outer_files,
+    'getfile': async_views.get_file_to_outer,
+    'get_outer': async_views.load_file_and_return,
+}
+
+urlpatterns = [
+    path(str(pattern.pattern), async_views_by_name[pattern.name], name=pattern.name)
+    if pattern.name in async_views_by_name else pattern
+    for pattern in sync_urlpatterns
+]
@@ -0,0 +1,115 @@
+import functools
+import mimetypes
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseServerError, JsonResponse
+from django.shortcuts import render
+
+from client.settings import CLIENT_PORT, FILE_SERVE_BLOCK_SIZE
+from client_app import async_http_client, metrics
+from client_app.helper import get_setting
+from client_app.peers import ServerError, get_online_clients_async, search_peers_async
+from client_app.search import SearchError, parse_search_params, search_lines, search_page
+from client_app.serving import AsyncStreamingResponse, serve_file
+from client_app.views import get_login_info, get_shared_file
+
+
+def async_login_required(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def search_file(request):
+    if 'search_str' not in request.GET:
+        return HttpResponseServerError('Cannot find parameter "search_str"')
+    try:
+        limit, fields, cursor = parse_search_params(request.GET)
+    except SearchError as e:
+        return HttpResponseBadRequest(str(e))
+    if request.GET.get('stream') == '1':
+        # one page is at most SEARCH_MAX_LIMIT lines, it is built in one go
+        lines = await sync_to_async(lambda: list(search_lines(request.GET['search_str'], limit, fields, cursor)))()
+        return HttpResponse(''.join(lines), content_type='application/x-ndjson')
+    files, next_cursor = await sync_to_async(search_page)(request.GET['search_str'], limit, fields, cursor)
+    return JsonResponse({
+        'files': files,
+        'next': next_cursor
+    })
+
+
+async def get_outer_storage_file_info(search_str):
+    with metrics.outer_search_seconds.time():
+        server, token, my_user = await sync_to_async(
+            lambda: (get_setting('server'), get_setting('token'), get_setting('login'))
+        )()
+        if not server or not token:
+            return [], 'Try to log in first'
+        try:
+            available = await get_online_clients_async(server, token)
+        except ServerError as e:
+            return [], str(e)
+        addresses = [client['address'] for client in available if client['user'] != my_user]
+        results, timed_out, _ = await search_peers_async(addresses, search_str)
+        found_files = [file for address in addresses for file in results.get(address, [])]
+        timeout_text = f'No answer from: {", ".join(timed_out)}' if timed_out else ''
+        if not found_files:
+            return [], timeout_text or 'No files found!'
+        return found_files, timeout_text
+
+
+@async_login_required
+async def search_outer_files(request):
+    files_list, error = [], ''
+    if 'search_str' in request.GET:
+        files_list, error = await get_outer_storage_file_info(request.GET['search_str'])
+    return await sync_to_async(lambda: render(
+        request,
+        'client_app/outer_files.html',
+        {'files_list': files_list, 'error_text': error, **get_login_info()}
+    ))()
+
+
+async def get_file_to_outer(request):
+    if 'name' not in request.GET or 'file_hash' not in request.GET:
+        return HttpResponseServerError('Required fields "name" and "file_hash" are empty')
+
+    file = await sync_to_async(get_shared_file)(name=request.GET['name'], file_hash=request.GET['file_hash'])
+    # open and fstat off the event loop, the body is read by aread_range
+    return await sync_to_async(serve_file, thread_sensitive=False)(request, file, use_async=True)
+
+
+async def aiter_response(response):
+    try:
+        async for chunk in response.aiter_bytes(FILE_SERVE_BLOCK_SIZE):
+            yield chunk
+    finally:
+        await response.aclose()
+
+
+@async_login_required
+async def load_file_and_return(request):
+    client = async_http_client.get_client()
+    response = await client.send(
+        client.build_request(
+            'GET',
+            f'http://{request.GET["ip"]}:{CLIENT_PORT}/getfile',
+            params={'name': request.GET['name'], 'file_hash': request.GET['file_hash']}
+        ),
+        stream=True
+    )
+    mime_type, _ = mimetypes.guess_type(request.GET['name'])
+    if response.status_code != 200:
+        await response.aclose()
+        proxied = HttpResponse(b'', content_type=mime_type)
+    else:
+        # the peer's body goes through without being held in memory
+        proxied = AsyncStreamingResponse(aiter_response(response), content_type=mime_type)
+        if 'Content-Length' in response.headers:
+            proxied['Content-Length'] = response.headers['Content-Length']
+    proxied['Content-Disposition'] = f"attachment; filename={request.GET['name']}"
+    return proxied
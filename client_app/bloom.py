@@ -0,0 +1,46 @@
+import base64
+import hashlib
+import math
+
+
+class BloomFilter:
+    # size in bits, positions come from one blake2b digest by double hashing
+    def __init__(self, size, hash_count, bits=None):
+        self.size = size
+        self.hash_count = hash_count
+        self.bits = bytearray((size + 7) // 8) if bits is None else bytearray(bits)
+
+    @classmethod
+    def for_items(cls, count, false_positive_rate, max_bytes):
+        # the optimal size for the wanted rate, capped at max_bytes - the rate goes up instead
+        size = math.ceil(-max(count, 1) * math.log(false_positive_rate) / math.log(2) ** 2)
+        size = max(64, min(size, max_bytes * 8))
+        return cls(size, max(1, round(size / max(count, 1) * math.log(2))))
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + number * second) % self.size for number in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    def false_positive_rate(self):
+        # expected from the share of set bits
+        ones = bin(int.from_bytes(self.bits, 'little')).count('1')
+        return (ones / self.size) ** self.hash_count
+
+    def to_dict(self):
+        return {'size': self.size, 'hash_count': self.hash_count, 'bits': base64.b64encode(self.bits).decode()}
+
+    @classmethod
+    def from_dict(cls, data):
+        bloom = cls(int(data['size']), int(data['hash_count']), base64.b64decode(data['bits']))
+        if len(bloom.bits) != (bloom.size + 7) // 8 or bloom.hash_count < 1:
+            raise ValueError('Broken bloom filter')
+        return bloom
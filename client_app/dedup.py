@@ -0,0 +1,121 @@
+import fcntl
+import logging
+import os
+import shutil
+from collections import defaultdict, namedtuple
+
+from django.db.models import Count
+
+from client_app import downloads, hash_cache
+from client_app.models import File
+
+logger = logging.getLogger(__name__)
+
+# ioctl_ficlone(2), supported by btrfs, xfs and other filesystems sharing extents
+_FICLONE = 0x40049409
+
+LINK_MODES = ('hardlink', 'reflink')
+
+DuplicateGroup = namedtuple('DuplicateGroup', ['size', 'file_hash', 'files'])
+
+
+def iter_duplicate_groups(storage_ids=None):
+    files = File.objects.exclude(file_hash='').filter(size__gt=0)
+    if storage_ids:
+        files = files.filter(storage_id__in=storage_ids)
+    # grouped by size first, files of a unique size are never compared by hash
+    keys = (
+        files
+        .values('size', 'file_hash')
+        .annotate(copies=Count('id'))
+        .filter(copies__gt=1)
+        .order_by('-size', 'file_hash')
+    )
+    for key in keys.iterator():
+        copies = files.filter(size=key['size'], file_hash=key['file_hash']).order_by('storage__date', 'id')
+        yield DuplicateGroup(key['size'], key['file_hash'], list(copies))
+
+
+def get_reclaimable(groups):
+    # {storage id: bytes} freed if every copy is linked to the first one of its group
+    reclaimable = defaultdict(int)
+    for group in groups:
+        # hardlinked copies share the inode and take no extra space, reflinked ones can not be told apart
+        inodes = {group.files[0].inode}
+        for file in group.files[1:]:
+            if file.inode is None or file.inode not in inodes:
+                reclaimable[file.storage_id] += group.size
+                inodes.add(file.inode)
+    return reclaimable
+
+
+def reflink(source, target):
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+
+
+def link_file(source, target, mode):
+    # target is replaced at once, it stays untouched if linking fails
+    temp = os.path.join(os.path.dirname(target), f'.{os.path.basename(target)}.{os.getpid()}.dedup')
+    try:
+        if mode == 'hardlink':
+            os.link(source, temp)
+        else:
+            reflink(source, temp)
+            if os.path.exists(target):
+                shutil.copystat(target, temp)
+        os.replace(temp, target)
+    except OSError:
+        if os.path.lexists(temp):
+            os.remove(temp)
+        raise
+
+
+def remember_hash(path, file_hash):
+    # the link gets a new inode or mtime, the next scan should not read it again
+    stat = os.stat(path)
+    hash_cache.store({hash_cache.CacheKey(stat.st_ino, stat.st_dev, stat.st_size, stat.st_mtime_ns): file_hash})
+    return stat
+
+
+def deduplicate(group, mode):
+    # links every copy to the first unchanged copy on the same device, returns the freed bytes
+    sources = {}
+    freed = 0
+    for file in group.files:
+        stat = file.get_unchanged_stat()
+        if stat is None:
+            continue
+        source = sources.setdefault(stat.st_dev, (file, stat))
+        if source[1].st_ino == stat.st_ino:
+            continue
+        try:
+            link_file(source[0].path, file.path, mode)
+        except OSError as e:
+            logger.info('Cannot link %s to %s: %s', file.path, source[0].path, e)
+            continue
+        stat = remember_hash(file.path, group.file_hash)
+        file.mtime, file.inode = stat.st_mtime_ns, stat.st_ino
+        file.save(update_fields=['mtime', 'inode'])
+        freed += group.size
+    return freed
+
+
+def link_local_copy(file_hash, path):
+    # puts the content at path, or next to it if another file has that name, without reading it.
+    # Returns the path used, None if no local copy can be linked
+    copies = [file for file in File.objects.filter(file_hash=file_hash).order_by('id') if file.get_unchanged_stat()]
+    for file in copies:
+        if os.path.abspath(file.path) == os.path.abspath(path):
+            return path
+    path = downloads.get_free_path(path)
+    for file in copies:
+        # a reflink is an independent copy, a hardlink changes together with the original
+        for mode in reversed(LINK_MODES):
+            try:
+                link_file(file.path, path, mode)
+            except OSError:
+                continue
+            remember_hash(path, file_hash)
+            return path
+    return None
@@ -0,0 +1,138 @@
+import os
+import re
+import time
+
+import requests
+
+from client.settings import CLIENT_PORT, MEDIA_ROOT, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_PART_DIR, DOWNLOAD_RETRIES
+from client_app import http_client, metrics, name_index
+from client_app.hashing import hash_file
+from client_app.models import File, Storage
+from client_app.throttle import download_bucket, iter_throttled
+
+_progress_save_interval = 2
+
+_hash_re = re.compile(r'^[0-9a-f]{64}$')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class TransferProgress:
+    # keeps Transfer counters current without saving on every chunk
+    def __init__(self, transfer=None):
+        self.transfer = transfer
+        self.last_save = 0
+
+    def save(self, force=False):
+        if self.transfer is None:
+            return
+        now = time.monotonic()
+        if force or now - self.last_save >= _progress_save_interval:
+            self.transfer.save(update_fields=['size', 'bytes_done', 'updated'])
+            self.last_save = now
+
+    def start(self, size, done=0):
+        if self.transfer is not None:
+            self.transfer.size = size
+            self.transfer.bytes_done = done
+            self.save(force=True)
+
+    def add(self, count):
+        metrics.transfer_bytes.inc(count, direction='download')
+        if self.transfer is not None:
+            self.transfer.bytes_done += count
+            self.save()
+
+
+def get_media_path(name):
+    # names come from other clients, never let them leave MEDIA_ROOT
+    return os.path.join(MEDIA_ROOT, os.path.basename(name))
+
+
+def get_free_path(path):
+    # an existing file is never replaced, the new one gets a number: name (1).ext
+    root, extension = os.path.splitext(path)
+    number = 0
+    while os.path.lexists(path):
+        number += 1
+        path = f'{root} ({number}){extension}'
+    return path
+
+
+def fetch_part(ip, name, file_hash, part_path, chunk_size, progress):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-', 'If-Range': f'"{file_hash}"'} if offset else {}
+    with http_client.get(
+        f'http://{ip}:{CLIENT_PORT}/getfile',
+        params={'name': name, 'file_hash': file_hash},
+        headers=headers,
+        stream=True
+    ) as response:
+        # nothing left to download
+        if response.status_code == 416 and offset:
+            return
+        if response.status_code == 206:
+            content_range = response.headers.get('Content-Range', '')
+            if not content_range.startswith(f'bytes {offset}-'):
+                raise DownloadError('Peer answered with a wrong range')
+            mode = 'ab'
+            progress.start(int(content_range.rsplit('/', 1)[-1]), offset)
+        elif response.status_code == 200:
+            mode = 'wb'
+            progress.start(int(response.headers.get('Content-Length', 0)) or None)
+        else:
+            raise DownloadError(f'Error while downloading file: {response.status_code}')
+        with open(part_path, mode) as f:
+            for chunk in iter_throttled(response.iter_content(chunk_size=chunk_size), download_bucket):
+                f.write(chunk)
+                progress.add(len(chunk))
+
+
+def check_file_hash(file_hash):
+    # the hash names the .part file, so it must not carry a path
+    if not _hash_re.match(file_hash):
+        raise DownloadError('Wrong file hash')
+
+
+def get_part_path(file_hash):
+    # unfinished downloads live outside of the storages so they are never indexed
+    return os.path.join(DOWNLOAD_PART_DIR, f'{file_hash}.part')
+
+
+def download_file(ip, name, file_hash, chunk_size=DOWNLOAD_CHUNK_SIZE, progress=None):
+    # a broken transfer continues from the end of its .part file
+    check_file_hash(file_hash)
+    os.makedirs(DOWNLOAD_PART_DIR, exist_ok=True)
+    os.makedirs(MEDIA_ROOT, exist_ok=True)
+    path = get_media_path(name)
+    part_path = get_part_path(file_hash)
+    progress = progress or TransferProgress()
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            fetch_part(ip, name, file_hash, part_path, chunk_size, progress)
+            break
+        except requests.exceptions.RequestException:
+            if attempt == DOWNLOAD_RETRIES:
+                raise DownloadError(f'Connection to {ip} lost, load the file again to resume')
+
+    if hash_file(part_path) != file_hash:
+        os.remove(part_path)
+        raise DownloadError('Downloaded file does not match its hash')
+    path = get_free_path(path)
+    os.replace(part_path, path)
+    return path
+
+
+def register_media_file(path, file_hash):
+    file_obj, created = File.objects.get_or_create(
+        path=path, storage=Storage.objects.get_or_create(path=MEDIA_ROOT)[0]
+    )
+    file_obj.name = os.path.basename(path)
+    stat = os.stat(path)
+    file_obj.size, file_obj.mtime, file_obj.inode = stat.st_size, stat.st_mtime_ns, stat.st_ino
+    file_obj.file_hash = file_hash
+    file_obj.save()
+    name_index.touch(file_obj.storage_id, added=int(created))
+    return file_obj
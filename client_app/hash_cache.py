@@ -0,0 +1,88 @@
+from collections import namedtuple
+from datetime import timedelta
+
+from django.utils import timezone
+
+from client.settings import HASH_CACHE_COUNT_EVERY, HASH_CACHE_MAX_AGE, HASH_CACHE_MAX_ENTRIES, HASH_WORKERS
+from client_app import metrics
+from client_app.hashing import hash_files
+from client_app.models import HashCache
+from client_app.pagination import estimate_rows
+
+_batch_size = 1000
+
+CacheKey = namedtuple('CacheKey', ['inode', 'device', 'size', 'mtime'])
+
+_evictions = 0
+
+
+def lookup(keys, counters=None):
+    found = {}
+    for start in range(0, len(keys), _batch_size):
+        batch = set(keys[start:start + _batch_size])
+        hit_ids = []
+        for cache_id, inode, device, size, mtime, file_hash in (
+            HashCache
+            .objects
+            .filter(inode__in={key.inode for key in batch})
+            .values_list('id', 'inode', 'device', 'size', 'mtime', 'file_hash')
+        ):
+            key = CacheKey(inode, device, size, mtime)
+            if key in batch:
+                found[key] = file_hash
+                hit_ids.append(cache_id)
+        # one update per batch keeps the hits from being evicted
+        if hit_ids:
+            HashCache.objects.filter(id__in=hit_ids).update(last_seen=timezone.now())
+    metrics.cache_hits.inc(len(found), cache='hash')
+    metrics.cache_misses.inc(len(keys) - len(found), cache='hash')
+    if counters is not None:
+        counters['hits'] = counters.get('hits', 0) + len(found)
+        counters['misses'] = counters.get('misses', 0) + len(keys) - len(found)
+    return found
+
+
+def store(hashes):
+    HashCache.objects.bulk_create(
+        [HashCache(file_hash=file_hash, **key._asdict()) for key, file_hash in hashes.items()],
+        batch_size=_batch_size,
+        ignore_conflicts=True,
+    )
+
+
+def evict(max_age=HASH_CACHE_MAX_AGE, max_entries=HASH_CACHE_MAX_ENTRIES, count_every=HASH_CACHE_COUNT_EVERY):
+    # drop the entries not seen for max_age days, a range of the last_seen index instead of counting the table
+    global _evictions
+    deleted, _ = HashCache.objects.filter(last_seen__lt=timezone.now() - timedelta(days=max_age)).delete()
+    # then the least recently seen above max_entries, sized by the planner estimate or a count every few calls
+    entries = estimate_rows(HashCache)
+    if entries is None:
+        _evictions += 1
+        if (_evictions - 1) % count_every:
+            return deleted
+        entries = HashCache.objects.count()
+    else:
+        entries -= deleted
+    excess = entries - max_entries
+    if excess <= 0:
+        return deleted
+    old_ids = list(HashCache.objects.order_by('last_seen', 'id').values_list('id', flat=True)[:excess])
+    for start in range(0, len(old_ids), _batch_size):
+        HashCache.objects.filter(id__in=old_ids[start:start + _batch_size]).delete()
+    return deleted + len(old_ids)
+
+
+def cached_hash_files(paths_with_keys, counters=None, workers=HASH_WORKERS):
+    # yields (path, hex digest) like hash_files, reading only files missing from the cache
+    paths_with_keys = list(paths_with_keys)
+    for start in range(0, len(paths_with_keys), _batch_size):
+        batch = paths_with_keys[start:start + _batch_size]
+        cached = lookup([key for _, key in batch], counters)
+        to_hash = [(path, key) for path, key in batch if key not in cached]
+        hashed = {}
+        for (path, file_hash), (_, key) in zip(hash_files((path for path, _ in to_hash), workers=workers), to_hash):
+            if file_hash is not None:
+                hashed[key] = file_hash
+        store(hashed)
+        for path, key in batch:
+            yield path, cached.get(key) or hashed.get(key)
@@ -0,0 +1,86 @@
+import hashlib
+import mmap
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from client.settings import HASH_CHUNK_SIZE, HASH_WORKERS, HASH_USE_PROCESSES, HASH_USE_MMAP
+from client_app import metrics
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE, use_mmap=HASH_USE_MMAP):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as opened_file:
+        size = os.fstat(opened_file.fileno()).st_size
+        # empty files cannot be mapped
+        if use_mmap and size:
+            with mmap.mmap(opened_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for start in range(0, len(view), chunk_size):
+                    digest.update(view[start:start + chunk_size])
+        else:
+            buffer = bytearray(chunk_size)
+            with memoryview(buffer) as view:
+                while True:
+                    read = opened_file.readinto(buffer)
+                    if not read:
+                        break
+                    digest.update(view[:read])
+    return digest.hexdigest()
+
+
+def hash_pieces(path, piece_size, chunk_size=HASH_CHUNK_SIZE):
+    # hex digests of consecutive piece_size blocks, the last one may be shorter
+    pieces = []
+    with open(path, 'rb') as opened_file:
+        while True:
+            digest = hashlib.sha256()
+            left = piece_size
+            while left:
+                block = opened_file.read(min(chunk_size, left))
+                if not block:
+                    break
+                digest.update(block)
+                left -= len(block)
+            if left == piece_size:
+                break
+            pieces.append(digest.hexdigest())
+    return pieces
+
+
+def _hash_or_none(path, chunk_size, use_mmap):
+    # also returns the size and the time taken, workers may run in other processes
+    start = time.perf_counter()
+    try:
+        return path, hash_file(path, chunk_size, use_mmap), os.path.getsize(path), time.perf_counter() - start
+    except OSError:
+        return path, None, 0, 0
+
+
+def _record(result):
+    path, digest, size, seconds = result
+    if digest is not None:
+        metrics.hashed_bytes.inc(size)
+        metrics.hash_seconds.observe(seconds)
+    return path, digest
+
+
+def hash_files(paths, workers=HASH_WORKERS, use_processes=HASH_USE_PROCESSES,
+               chunk_size=HASH_CHUNK_SIZE, use_mmap=HASH_USE_MMAP):
+    # yields (path, hex digest) in input order, digest is None for unreadable files
+    worker = partial(_hash_or_none, chunk_size=chunk_size, use_mmap=use_mmap)
+    if workers <= 1:
+        yield from map(_record, map(worker, paths))
+        return
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        # keep a bounded window of pending jobs so huge path lists are not submitted at once
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(worker, path))
+            if len(pending) >= workers * 4:
+                yield _record(pending.popleft().result())
+        while pending:
+            yield _record(pending.popleft().result())
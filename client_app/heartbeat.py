@@ -0,0 +1,77 @@
+import logging
+import random
+import statistics
+import time
+from collections import deque
+
+import requests
+from django.db import close_old_connections
+
+from client.settings import (
+    SERVER_PORT, HEARTBEAT_INTERVAL, HEARTBEAT_MAX_BACKOFF, HEARTBEAT_JITTER, HEARTBEAT_LATENCY_STEP
+)
+from client_app import http_client, metrics
+from client_app.helper import get_setting, save_settings
+
+logger = logging.getLogger(__name__)
+
+_latency_samples = 10
+
+
+class Heartbeat:
+    # pings the server over one keep-alive connection and stores only changes of the link state
+    def __init__(self, interval=HEARTBEAT_INTERVAL, max_backoff=HEARTBEAT_MAX_BACKOFF, jitter=HEARTBEAT_JITTER):
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.failures = 0
+        self.latencies = deque(maxlen=_latency_samples)
+
+    def ping(self):
+        # (online, latency in ms), latency is None when the server did not answer
+        server = get_setting('server')
+        token = get_setting('token')
+        if not server or not token:
+            return False, None
+        start = time.perf_counter()
+        try:
+            response = http_client.get(
+                f'http://{server}:{SERVER_PORT}/ping', headers={'Authorization': f'TOKEN {token}'}
+            )
+        except requests.exceptions.RequestException as e:
+            logger.info('Server %s is not reachable: %s', server, e)
+            metrics.peer_errors.inc(operation='ping')
+            return False, None
+        elapsed = time.perf_counter() - start
+        metrics.peer_seconds.observe(elapsed, operation='ping')
+        return response.status_code == 200, round(elapsed * 1000)
+
+    def record(self, online, latency):
+        changes = {}
+        if get_setting('is_online') != ('1' if online else '0'):
+            changes['is_online'] = '1' if online else '0'
+        if latency is not None:
+            self.latencies.append(latency)
+            # the median of recent pings, small jitter of the link is not worth a write
+            median = round(statistics.median(self.latencies))
+            published = get_setting('ping_latency')
+            if published is None or abs(median - int(published)) > max(HEARTBEAT_LATENCY_STEP, int(published) // 4):
+                changes['ping_latency'] = str(median)
+        if changes:
+            save_settings(changes)
+
+    def next_delay(self, online):
+        # exponential backoff while the server is unreachable, jitter keeps clients from pinging in step
+        self.failures = 0 if online else self.failures + 1
+        delay = min(self.interval * 2 ** self.failures, self.max_backoff)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def beat(self):
+        online, latency = self.ping()
+        close_old_connections()
+        self.record(online, latency)
+        return self.next_delay(online)
+
+    def run(self):
+        while True:
+            time.sleep(self.beat())
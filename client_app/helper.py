@@ -1,14 +1,49 @@
+import threading
+import time
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from client.settings import SETTINGS_CACHE_TTL
 from client_app.models import Settings
 
+# every setting of the process, other processes see a write after SETTINGS_CACHE_TTL at most
+_cache = {'values': None, 'loaded': 0}
+_lock = threading.Lock()
+
+
+def load_settings():
+    with _lock:
+        if _cache['values'] is None or time.monotonic() - _cache['loaded'] >= SETTINGS_CACHE_TTL:
+            _cache['values'] = dict(Settings.objects.values_list('name', 'value'))
+            _cache['loaded'] = time.monotonic()
+        return _cache['values']
+
+
+@receiver([post_save, post_delete], sender=Settings)
+def invalidate_settings(**kwargs):
+    with _lock:
+        _cache['values'] = None
+
+
+def save_settings(values):
+    # writes only the settings that changed
+    current = dict(Settings.objects.filter(name__in=values).values_list('name', 'value'))
+    new = [Settings(name=name, value=value) for name, value in values.items() if name not in current]
+    changed = [name for name, value in values.items() if name in current and current[name] != value]
+    if not new and not changed:
+        return
+    with transaction.atomic():
+        Settings.objects.bulk_create(new, ignore_conflicts=True)
+        for name in changed:
+            Settings.objects.filter(name=name).update(value=values[name])
+    invalidate_settings()
+
 
 def save_setting(name, value):
-    setting, created = Settings.objects.get_or_create(name=name)
-    setting.value = value
-    setting.save()
+    save_settings({name: value})
 
 
 def get_setting(name):
-    try:
-        return Settings.objects.get(name=name).value
-    except Settings.DoesNotExist:
-        return None
+    return load_settings().get(name)
@@ -0,0 +1,151 @@
+import io
+import os
+import time
+
+from django.db import connection, transaction
+
+from client.settings import HASH_WORKERS
+from client_app import hash_cache, name_index
+from client_app.models import File
+from client_app.scanner import FileState, load_known_state, walk_files
+
+_copy_columns = ('name', 'path', 'file_hash', 'storage_id', 'hidden', 'size', 'mtime', 'inode')
+
+
+class IndexResult:
+    def __init__(self):
+        self.seen = 0
+        self.written = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.bytes = 0
+        self.cache_counters = {'hits': 0, 'misses': 0}
+        self.start = time.perf_counter()
+
+    def __str__(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        megabytes = self.bytes / 1048576
+        return (
+            f'seen {self.seen}, written {self.written}, skipped {self.skipped}, deleted {self.deleted}, '
+            f'hash cache {self.cache_counters["hits"]} hits / {self.cache_counters["misses"]} misses, '
+            f'{megabytes:.1f} MB in {elapsed:.1f}s: {self.seen / elapsed:.0f} files/s, {megabytes / elapsed:.1f} MB/s'
+        )
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_files(files):
+    # COPY skips the per-row overhead of INSERT, postgres only
+    buffer = io.StringIO()
+    for file in files:
+        buffer.write('\t'.join(_copy_value(getattr(file, column)) for column in _copy_columns) + '\n')
+    buffer.seek(0)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {File._meta.db_table} ({", ".join(_copy_columns)}) FROM STDIN', buffer)
+
+
+def create_files(files, batch_size):
+    if connection.vendor == 'postgresql':
+        copy_files(files)
+    else:
+        File.objects.bulk_create(files, batch_size=batch_size)
+
+
+def index_storage(storage, skip_dirs=(), workers=HASH_WORKERS, batch_size=1000, with_hash=True, resume=False,
+                  progress=None):
+    # streams the walk into File batch by batch, every batch is committed on its own
+    result = IndexResult()
+    added = 0
+    if resume:
+        # rows written by an earlier run are kept, unchanged files cost only a stat
+        known = load_known_state(storage)
+        wiped = 0
+    else:
+        known = {}
+        wiped = File.objects.filter(storage=storage).delete()[0]
+
+    for batch in batched(walk_files(storage.path, skip_dirs), batch_size):
+        changed = []
+        for path, stat in batch:
+            state = FileState(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            file_id, known_state = known.pop(path, (None, None))
+            if known_state == state:
+                result.skipped += 1
+            else:
+                changed.append((path, file_id, state, stat.st_dev))
+        result.seen += len(batch)
+
+        if with_hash:
+            hashes = hash_cache.cached_hash_files(
+                (
+                    (path, hash_cache.CacheKey(state.inode, device, state.size, state.mtime))
+                    for path, _, state, device in changed
+                ),
+                result.cache_counters,
+                workers,
+            )
+        else:
+            hashes = ((path, '') for path, _, _, _ in changed)
+        to_create = []
+        to_update = []
+        deleted_ids = []
+        for (path, file_id, state, _), (_, file_hash) in zip(changed, hashes):
+            # file vanished or became unreadable between walk and hash
+            if file_hash is None:
+                if file_id is not None:
+                    deleted_ids.append(file_id)
+                continue
+            file_obj = File(
+                id=file_id,
+                path=path,
+                storage=storage,
+                name=os.path.basename(path),
+                file_hash=file_hash,
+                size=state.size,
+                mtime=state.mtime,
+                inode=state.inode,
+            )
+            if file_id is None:
+                to_create.append(file_obj)
+            else:
+                to_update.append(file_obj)
+            result.bytes += state.size
+
+        with transaction.atomic():
+            if to_create:
+                create_files(to_create, batch_size)
+            if to_update:
+                File.objects.bulk_update(to_update, ['file_hash', 'size', 'mtime', 'inode'], batch_size=batch_size)
+            if deleted_ids:
+                result.deleted += File.objects.filter(id__in=deleted_ids).delete()[0]
+        added += len(to_create)
+        result.written += len(to_create) + len(to_update)
+        if progress is not None:
+            progress(result)
+
+    # what an earlier run indexed and the walk did not find anymore was removed from disk since
+    gone_ids = [file_id for file_id, _ in known.values()]
+    for start in range(0, len(gone_ids), batch_size):
+        result.deleted += File.objects.filter(id__in=gone_ids[start:start + batch_size]).delete()[0]
+
+    if with_hash:
+        hash_cache.evict()
+    name_index.touch(storage.id, added=added, deleted=wiped + result.deleted)
+    return result
@@ -0,0 +1,646 @@
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+import requests
+import uvicorn
+from background_task.models import Task
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client, RequestFactory
+from django.utils import timezone
+from django.views.generic import ListView
+
+from client.asgi import ClientASGIHandler
+from client.settings import BASE_DIR, CLIENT_PORT, HASH_LOOKUP_MAX, SERVER_PORT
+from client_app import name_index, outer_cache, summary
+from client_app.bloom import BloomFilter
+from client_app.hashing import hash_file, hash_files
+from client_app.helper import save_settings
+from client_app.models import File, Storage
+from client_app.pagination import encode_cursor
+from client_app.peers import PeerSearch, search_peer
+from client_app.scanner import walk_files
+from client_app.tasks import scan_storage_task
+from client_app.views import (
+    LocalFiles, get_file_to_outer, get_outer_storage_file_info, lookup_file_hashes, refresh_storage_files, search_file
+)
+
+_words = ['holiday', 'report', 'music', 'camera', 'backup', 'invoice', 'season', 'episode', 'draft', 'photo']
+_extensions = ['mp4', 'jpg', 'txt', 'pdf', 'mkv', 'flac']
+_files_per_directory = 100
+# stub coordinator of outer_search, away from the peers on 127.0.0.x
+_stub_server_address = '127.0.1.1'
+# options every command has, they do not describe a run
+_django_options = {'verbosity', 'settings', 'pythonpath', 'traceback', 'no_color', 'force_color', 'skip_checks', 'json'}
+
+
+def make_files(directory, count, size):
+    block = os.urandom(min(size, 1024 * 1024))
+    paths = []
+    for number in range(count):
+        path = os.path.join(directory, f'bench_{number}')
+        with open(path, 'wb') as f:
+            written = 0
+            while written < size:
+                written += f.write(block[:size - written])
+        paths.append(path)
+    return paths
+
+
+def make_storage(directory, count, size, max_size):
+    # files spread over subdirectories, sizes log-uniform between size and max_size, returns the total size
+    block = os.urandom(1024 * 1024)
+    total = 0
+    for number in range(count):
+        subdirectory = os.path.join(directory, f'dir_{number // _files_per_directory}')
+        os.makedirs(subdirectory, exist_ok=True)
+        file_size = round(math.exp(random.uniform(math.log(size), math.log(max(size, max_size)))))
+        name = f'{random.choice(_words)}_{number}.{random.choice(_extensions)}'
+        with open(os.path.join(subdirectory, name), 'wb') as f:
+            # the number keeps contents and hashes apart
+            written = f.write(number.to_bytes(8, 'little')[:file_size])
+            while written < file_size:
+                written += f.write(block[:file_size - written])
+        total += file_size
+    return total
+
+
+def benchmark_hashing(options):
+    directory = tempfile.mkdtemp()
+    try:
+        size = options['size'] or 64 * 1024 * 1024
+        files = options['files'] or 8
+        paths = make_files(directory, files, size)
+        total_mb = files * size / 1048576
+        results = []
+        for workers in options['workers']:
+            for use_mmap in (False, True):
+                start = time.perf_counter()
+                for _ in hash_files(paths, workers=workers, use_processes=options['processes'], use_mmap=use_mmap):
+                    pass
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'workers': workers,
+                    'mmap': use_mmap,
+                    'seconds': round(elapsed, 3),
+                    'mb_per_second': round(total_mb / elapsed, 1),
+                })
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+class StubPeerHandler(BaseHTTPRequestHandler):
+    delay = 0
+    files = []
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = json.dumps({'files': self.files}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the asgi load test opens many connections at once
+    request_queue_size = 128
+
+
+class StubServerHandler(BaseHTTPRequestHandler):
+    addresses = []
+
+    def do_GET(self):
+        available = [{'user': f'peer_{number}', 'address': address} for number, address in enumerate(self.addresses)]
+        body = json.dumps({'available': available}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server(addresses):
+    handler = type('Handler', (StubServerHandler,), {'addresses': addresses})
+    server = StubHTTPServer((_stub_server_address, int(SERVER_PORT)), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_stub_peers(count, slow, delay, files):
+    # every peer listens on its own loopback address, as real peers share CLIENT_PORT
+    servers = []
+    for number in range(count):
+        handler = type('Handler', (StubPeerHandler,), {'delay': delay if number < slow else 0, 'files': files})
+        server = StubHTTPServer((f'127.0.0.{number + 2}', int(CLIENT_PORT)), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def benchmark_outer_search(options):
+    files = [{'name': f'file_{number}', 'size': number, 'file_hash': '0' * 64} for number in range(options['results'])]
+    servers = start_stub_peers(options['peers'], options['slow_peers'], options['delay'], files)
+    addresses = [server.server_address[0] for server in servers]
+    try:
+        start = time.perf_counter()
+        found = 0
+        for address in addresses:
+            try:
+                found += len(search_peer(address, 'file'))
+            except requests.exceptions.RequestException:
+                pass
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        search = PeerSearch(addresses, 'file', use_cache=False)
+        first_answer = None
+        parallel_found = 0
+        for _, peer_files in search:
+            first_answer = first_answer or time.perf_counter() - start
+            parallel_found += len(peer_files)
+        parallel = time.perf_counter() - start
+        results = [
+            {'mode': 'sequential', 'seconds': round(sequential, 3), 'files': found},
+            {
+                'mode': 'parallel',
+                'seconds': round(parallel, 3),
+                'first_answer_seconds': round(first_answer or 0, 3),
+                'files': parallel_found,
+                'timed_out': len(search.timed_out),
+            },
+        ]
+
+        # the whole outer search page: online list from the server, then every peer
+        servers.append(start_stub_server(addresses))
+        with benchmark_database():
+            save_settings({'server': _stub_server_address, 'token': 'benchmark', 'login': 'benchmark'})
+            for mode in ('view uncached', 'view cached'):
+                timings = []
+                for _ in range(options['queries']):
+                    if mode == 'view uncached':
+                        outer_cache.invalidate()
+                    start = time.perf_counter()
+                    files, _ = get_outer_storage_file_info('file')
+                    timings.append(time.perf_counter() - start)
+                results.append({'mode': mode, 'files': len(files), **percentiles(timings)})
+        return results
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+@contextmanager
+def benchmark_database():
+    # seed into a throwaway test database, never into the real one
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def seed_files(rows, batch_size=10000):
+    storage = Storage.objects.create(path='/benchmark')
+    for start in range(0, rows, batch_size):
+        File.objects.bulk_create(
+            File(
+                name=f'{random.choice(_words)}_{number}.{random.choice(_extensions)}',
+                path=f'/benchmark/{number}',
+                file_hash=f'{number:064x}',
+                storage=storage,
+                size=number,
+                hidden=number % 50 == 0,
+            )
+            for number in range(start, min(start + batch_size, rows))
+        )
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return {
+        'p50_ms': round(timings[len(timings) // 2] * 1000, 2),
+        'p99_ms': round(timings[min(len(timings) - 1, len(timings) * 99 // 100)] * 1000, 2),
+    }
+
+
+def benchmark_search(options):
+    factory = RequestFactory()
+    with benchmark_database():
+        start = time.perf_counter()
+        seed_files(options['rows'])
+        seeded = time.perf_counter() - start
+
+        index = name_index.NameIndex()
+        index.sync()
+        # what the refresh of a running server costs: nothing changed, then one new file
+        start = time.perf_counter()
+        index.sync()
+        idle_sync = time.perf_counter() - start
+        storage = Storage.objects.first()
+        File.objects.create(name='new file', path='/benchmark/new', file_hash='f' * 64, storage=storage, size=1)
+        name_index.touch(storage.id, added=1)
+        start = time.perf_counter()
+        index.sync()
+        one_file_sync = time.perf_counter() - start
+
+        results = []
+        for mode, source in (('database', None), ('memory', index)):
+            name_index.set_index(source)
+            for search_str in ['a', 'phot', 'season_1', 'no_such_file']:
+                timings = []
+                for _ in range(options['queries']):
+                    start = time.perf_counter()
+                    search_file(factory.get('/search', {'search_str': search_str})).render()
+                    timings.append(time.perf_counter() - start)
+                results.append({'mode': mode, 'search_str': search_str, **percentiles(timings)})
+        name_index.set_index(None)
+
+        # one POST /hashes with a whole list of seeded files, the hidden ones are not found
+        count = min(options['rows'], HASH_LOOKUP_MAX)
+        hashes = [f'{number:064x}' for number in range(count)]
+        timings = []
+        for _ in range(options['queries']):
+            request = factory.post('/hashes', {'hashes': hashes}, content_type='application/json')
+            start = time.perf_counter()
+            found = len(lookup_file_hashes(request).render().data['files'])
+            timings.append(time.perf_counter() - start)
+        results.append({'mode': 'hashes', 'hashes': count, 'found': found, **percentiles(timings)})
+    return [
+        {
+            'rows': options['rows'],
+            'seed_seconds': round(seeded, 1),
+            'index_build_seconds': round(index.build_seconds, 2),
+            'index_idle_sync_ms': round(idle_sync * 1000, 2),
+            'index_one_file_sync_ms': round(one_file_sync * 1000, 2),
+            'index_mb': round(index.memory_bytes() / 1048576, 1),
+        }
+    ] + results
+
+
+def benchmark_summary(options):
+    # size and real false positives of the summary for several wanted rates
+    with benchmark_database():
+        seed_files(options['rows'])
+        version = summary.get_version()
+        probes = options['queries'] * 1000
+        # random hashes and words are not in the seeded files, every hit is a false positive
+        hashes = [f'{random.getrandbits(256):064x}' for _ in range(probes)]
+        words = [''.join(random.choice('bcdfgjkqvwxz') for _ in range(6)) for _ in range(probes)]
+        results = []
+        for rate in (0.001, 0.01, 0.05):
+            start = time.perf_counter()
+            built = summary.build_summary(version, rate)
+            elapsed = time.perf_counter() - start
+            bloom = BloomFilter.from_dict(built)
+            results.append({
+                'wanted_rate': rate,
+                'items': built['items'],
+                'bytes': len(bloom.bits),
+                'build_seconds': round(elapsed, 2),
+                'expected_rate': built['false_positive_rate'],
+                'hash_rate': sum(item in bloom for item in hashes) / probes,
+                'search_rate': sum(all(item in bloom for item in summary.name_items(word)) for word in words) / probes,
+            })
+    return [{'rows': options['rows']}] + results
+
+
+def run_scans():
+    # what process_tasks would do, but in this process and in order
+    for task in Task.objects.filter(queue='scan'):
+        args, kwargs = task.params()
+        scan_storage_task.now(*args, **kwargs)
+        task.delete()
+
+
+def benchmark_refresh(options):
+    directory = tempfile.mkdtemp()
+    try:
+        files = options['files'] or 1000
+        total_mb = make_storage(directory, files, options['size'] or 64 * 1024, options['max_size'] or 0) / 1048576
+        with benchmark_database():
+            Storage.objects.create(path=directory)
+            request = RequestFactory().get('/storage/refresh')
+            request.user = User.objects.create_user('benchmark')
+            results = []
+            for mode in ('cold', 'unchanged', 'touched'):
+                if mode == 'touched':
+                    # a tenth of the files changed since the last refresh
+                    for path, stat in list(walk_files(directory))[::10]:
+                        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+                start = time.perf_counter()
+                refresh_storage_files(request)
+                run_scans()
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'mode': mode,
+                    'files': files,
+                    'seconds': round(elapsed, 3),
+                    'files_per_second': round(files / elapsed),
+                    'mb_per_second': round(total_mb / elapsed, 1),
+                })
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+class OffsetLocalFiles(ListView):
+    # LocalFiles as it was before keyset pagination: COUNT(*) and OFFSET on every page
+    template_name = 'client_app/local_files.html'
+    paginate_by = 10
+
+    def get_queryset(self):
+        return File.objects.filter(name__icontains=self.request.GET.get('search', '')).order_by('name')
+
+
+def benchmark_local_files(options):
+    factory = RequestFactory()
+    with benchmark_database():
+        seed_files(options['rows'])
+        name_index.touch(Storage.objects.get().id)
+        user = User.objects.create_user('benchmark')
+        deep_page = min(10000, max(options['rows'] // 10, 1))
+        # keyset pages are asked by the last row of the previous page, found here as the page links would have it
+        deep_cursor = None
+        if deep_page > 1:
+            row = File.objects.order_by('name', 'id').values('name', 'id')[(deep_page - 1) * 10 - 1]
+            deep_cursor = encode_cursor([row['name'], row['id']])
+        results = []
+        for mode, view, queries in [
+            ('offset', OffsetLocalFiles.as_view(), [
+                ('page 1', {}),
+                (f'page {deep_page}', {'page': deep_page}),
+                ('last page', {'page': 'last'}),
+                ('search', {'search': 'phot'}),
+            ]),
+            ('keyset', LocalFiles.as_view(), [
+                ('page 1', {}),
+                (f'page {deep_page}', {'after': deep_cursor} if deep_cursor else {}),
+                ('last page', {'last': '1'}),
+                ('search', {'search': 'phot'}),
+            ]),
+        ]:
+            for query, params in queries:
+                timings = []
+                for _ in range(options['queries']):
+                    request = factory.get('/local', params)
+                    request.user = user
+                    start = time.perf_counter()
+                    view(request).render()
+                    timings.append(time.perf_counter() - start)
+                results.append({'mode': mode, 'query': query, **percentiles(timings)})
+    return results
+
+
+def consume(make_response):
+    start = time.perf_counter()
+    response = make_response()
+    received = sum(len(chunk) for chunk in response)
+    response.close()
+    return received, time.perf_counter() - start
+
+
+def create_shared_file(directory, size):
+    path = make_files(directory, 1, size)[0]
+    stat = os.stat(path)
+    return File.objects.create(
+        name=os.path.basename(path),
+        path=path,
+        file_hash=hash_file(path),
+        storage=Storage.objects.create(path=directory),
+        size=stat.st_size,
+        mtime=stat.st_mtime_ns,
+        inode=stat.st_ino,
+    )
+
+
+def benchmark_transfer(options):
+    size = options['size'] or 1024 * 1024 * 1024
+    directory = tempfile.mkdtemp()
+    try:
+        with benchmark_database():
+            file = create_shared_file(directory, size)
+            request = RequestFactory().get('/getfile', {'name': file.name, 'file_hash': file.file_hash})
+            results = []
+            # how getfile answered before: the whole file goes through HttpResponse
+            with open(file.path, 'rb') as opened_file:
+                results.append(('HttpResponse', *consume(lambda: HttpResponse(opened_file))))
+            results.append(('getfile', *consume(lambda: get_file_to_outer(request))))
+        return [
+            {
+                'mode': mode,
+                'bytes': received,
+                'seconds': round(elapsed, 3),
+                'mb_per_second': round(received / 1048576 / elapsed, 1),
+            }
+            for mode, received, elapsed in results
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    # a fixed number of worker threads, like gunicorn --threads
+    request_queue_size = 128
+
+    def __init__(self, address, threads):
+        super().__init__(address, QuietWSGIRequestHandler)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+@contextmanager
+def serve_wsgi(threads):
+    server = PooledWSGIServer(('127.0.0.1', 0), threads)
+    server.set_app(WSGIHandler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def serve_asgi():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(ClientASGIHandler(), log_level='warning', lifespan='off'))
+    thread = threading.Thread(target=server.run, kwargs={'sockets': [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f'http://127.0.0.1:{sock.getsockname()[1]}'
+    finally:
+        server.should_exit = True
+        thread.join()
+        sock.close()
+
+
+def load(url, params_list, concurrency, cookies):
+    def fetch(params):
+        start = time.perf_counter()
+        response = requests.get(url, params=params, cookies=cookies)
+        return response.status_code == 200 and len(response.content) > 0, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        answers = list(executor.map(fetch, params_list))
+    elapsed = time.perf_counter() - start
+    return {
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(answers) / elapsed, 1),
+        'errors': sum(not ok for ok, _ in answers),
+        **percentiles([seconds for _, seconds in answers]),
+    }
+
+
+def benchmark_asgi(options):
+    # the same concurrent requests against a WSGI server with --threads workers and against uvicorn
+    files = [{'name': f'file_{number}', 'size': number, 'file_hash': '0' * 64} for number in range(options['results'])]
+    servers = start_stub_peers(options['peers'], options['slow_peers'], options['delay'], files)
+    servers.append(start_stub_server([server.server_address[0] for server in servers]))
+    directory = tempfile.mkdtemp()
+    try:
+        with benchmark_database():
+            save_settings({'server': _stub_server_address, 'token': 'benchmark', 'login': 'benchmark'})
+            file = create_shared_file(directory, options['size'] or 1024 * 1024)
+            client = Client()
+            client.force_login(User.objects.create_user('benchmark'))
+            cookies = {name: morsel.value for name, morsel in client.cookies.items()}
+            results = []
+            for mode, serve in (('wsgi', lambda: serve_wsgi(options['threads'])), ('asgi', serve_asgi)):
+                with serve() as base_url:
+                    # every outer search is new, answers cached by the other server do not help
+                    outer = load(
+                        base_url + '/outer',
+                        [{'search_str': f'{mode} {number}'} for number in range(options['requests'])],
+                        options['concurrency'],
+                        cookies,
+                    )
+                    getfile = load(
+                        base_url + '/getfile',
+                        [{'name': file.name, 'file_hash': file.file_hash}] * options['requests'],
+                        options['concurrency'],
+                        cookies,
+                    )
+                results.append({'server': mode, 'path': 'outer', **outer})
+                results.append({'server': mode, 'path': 'getfile', 'bytes': file.size, **getfile})
+        return [{'requests': options['requests'], 'concurrency': options['concurrency']}] + results
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(directory)
+
+
+targets = {
+    'hashing': benchmark_hashing,
+    'refresh': benchmark_refresh,
+    'local_files': benchmark_local_files,
+    'outer_search': benchmark_outer_search,
+    'search': benchmark_search,
+    'transfer': benchmark_transfer,
+    'asgi': benchmark_asgi,
+    'summary': benchmark_summary,
+}
+
+
+def get_commit():
+    try:
+        completed = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, capture_output=True, text=True)
+    except OSError:
+        return None
+    return completed.stdout.strip() or None
+
+
+class Command(BaseCommand):
+    help = 'Measure throughput of the hot paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=targets)
+        parser.add_argument('--files', type=int, help='files to create, 8 for hashing, 1000 for refresh')
+        parser.add_argument(
+            '--size',
+            type=int,
+            help='size of every file in bytes, 64 MB for hashing, 64 KB for refresh, 1 GB for transfer, 1 MB for asgi',
+        )
+        parser.add_argument('--max-size', type=int, help='refresh file sizes are spread between --size and this')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+        parser.add_argument('--processes', action='store_true', help='use a process pool instead of threads')
+        parser.add_argument('--peers', type=int, default=10, help='number of stub peers')
+        parser.add_argument('--slow-peers', type=int, default=2)
+        parser.add_argument('--delay', type=float, default=1, help='answer delay of slow peers in seconds')
+        parser.add_argument('--results', type=int, default=100, help='files returned by every stub peer')
+        parser.add_argument('--rows', type=int, default=1000000, help='File rows to seed')
+        parser.add_argument('--queries', type=int, default=20, help='repetitions of every query')
+        parser.add_argument('--requests', type=int, default=200, help='requests to every path in the asgi load test')
+        parser.add_argument('--concurrency', type=int, default=50, help='requests in flight in the asgi load test')
+        parser.add_argument('--threads', type=int, default=8, help='worker threads of the WSGI server')
+        parser.add_argument('--seed', type=int, default=0, help='seed of generated names and sizes')
+        parser.add_argument('--json', action='store_true', help='print one JSON document to compare runs')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        results = targets[options['target']](options)
+        if not options['json']:
+            for result in results:
+                self.stdout.write(', '.join(f'{name} {value}' for name, value in result.items()))
+            return
+        self.stdout.write(json.dumps(
+            {
+                'target': options['target'],
+                'commit': get_commit(),
+                'date': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'options': {name: value for name, value in options.items() if name not in _django_options},
+                'results': results,
+            },
+            indent=2,
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from client_app.dedup import LINK_MODES, deduplicate, get_reclaimable, iter_duplicate_groups
+from client_app.models import Storage
+from client_app.templatetags.extra_tags import sizify
+
+
+class Command(BaseCommand):
+    help = 'Report files stored more than once and optionally replace the copies with links'
+
+    def add_arguments(self, parser):
+        parser.add_argument('storages', type=int, nargs='*', help='storage ids, all storages by default')
+        parser.add_argument('--link', choices=LINK_MODES, help='replace duplicates instead of only reporting them')
+
+    def handle(self, *args, **options):
+        groups = list(iter_duplicate_groups(options['storages']))
+        reclaimable = get_reclaimable(groups)
+        for storage in Storage.objects.filter(id__in=reclaimable).order_by('date'):
+            self.stdout.write(f'{storage.path}: {sizify(reclaimable[storage.id])} reclaimable')
+        self.stdout.write(f'{len(groups)} duplicate groups, {sizify(sum(reclaimable.values()))} reclaimable')
+
+        if options['link']:
+            freed = sum(deduplicate(group, options['link']) for group in groups)
+            self.stdout.write(f'{sizify(freed)} freed')
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from client_app.heartbeat import Heartbeat
+
+
+class Command(BaseCommand):
+    help = 'Ping the server to keep this client online, runs alongside process_tasks'
+
+    def handle(self, *args, **options):
+        Heartbeat().run()
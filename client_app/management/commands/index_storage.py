@@ -0,0 +1,57 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from client.settings import HASH_WORKERS
+from client_app.indexer import index_storage
+from client_app.models import Storage
+from client_app.scanner import get_nested_storage_paths
+
+_progress_interval = 10
+
+
+class Command(BaseCommand):
+    help = 'Index a directory as a storage in one pass, without the web interface'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--workers', type=int, default=HASH_WORKERS, help='hashing threads')
+        parser.add_argument('--batch-size', type=int, default=1000, help='files written per transaction')
+        parser.add_argument(
+            '--no-hash',
+            action='store_true',
+            help='store files without hashes, they are shared once the next scan adds them',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='keep files indexed by an earlier run instead of indexing the storage from scratch',
+        )
+
+    def handle(self, *args, **options):
+        path = os.path.abspath(options['path'])
+        if not os.path.isdir(path):
+            raise CommandError('Path does not exists')
+        storage = Storage.objects.filter(path__in=[path, os.path.join(path, '')]).first()
+        if storage is None:
+            storage = Storage.objects.create(path=path)
+
+        last_report = time.monotonic()
+
+        def report(result):
+            nonlocal last_report
+            if time.monotonic() - last_report >= _progress_interval:
+                self.stdout.write(str(result))
+                last_report = time.monotonic()
+
+        result = index_storage(
+            storage,
+            get_nested_storage_paths(storage, Storage.objects.all()),
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            with_hash=not options['no_hash'],
+            resume=options['resume'],
+            progress=report,
+        )
+        self.stdout.write(str(result))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from client_app.watcher import StorageWatcher
+
+
+class Command(BaseCommand):
+    help = 'Keep the files of visible storages indexed as they change, runs alongside process_tasks'
+
+    def handle(self, *args, **options):
+        StorageWatcher().run()
@@ -0,0 +1,231 @@
+import atexit
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from client.settings import METRICS_DIR, METRICS_DUMP_INTERVAL, PEER_SLOW_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# every process (web server, process_tasks, heartbeat) dumps its metrics to METRICS_DIR,
+# /metrics sums the dumps of all running processes
+_lock = threading.Lock()
+_registry = {}
+_dump_timer = [None]
+
+_time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        _registry[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        maybe_dump()
+
+    def empty(self):
+        return 0
+
+    def merge(self, total, value):
+        return total + value
+
+    def format(self, key, value):
+        yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=_time_buckets):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with _lock:
+            # a count per bucket, then the total count and the sum
+            state = self.values.setdefault(key, self.empty())
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += 1
+            state[-1] += value
+        maybe_dump()
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        # works as a decorator as well
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def empty(self):
+        return [0] * (len(self.buckets) + 2)
+
+    def merge(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def format(self, key, value):
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            yield f'{self.name}_bucket{_format_labels(self.labels, key, [("le", bound)])} {cumulative}'
+        yield f'{self.name}_bucket{_format_labels(self.labels, key, [("le", "+Inf")])} {value[-2]}'
+        yield f'{self.name}_count{_format_labels(self.labels, key)} {value[-2]}'
+        yield f'{self.name}_sum{_format_labels(self.labels, key)} {round(value[-1], 6)}'
+
+
+@contextlib.contextmanager
+def time_peer(address, operation):
+    # peer_seconds has no peer label, the peers behind slow answers are logged instead
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        peer_seconds.observe(elapsed, operation=operation)
+        if elapsed >= PEER_SLOW_SECONDS:
+            logger.warning('Slow %s request to %s: %.2f s', operation, address, elapsed)
+
+
+def snapshot():
+    with _lock:
+        return {
+            name: [
+                [list(key), list(value) if isinstance(value, list) else value] for key, value in metric.values.items()
+            ]
+            for name, metric in _registry.items()
+        }
+
+
+def dump():
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def _timed_dump():
+    with _lock:
+        _dump_timer[0] = None
+    with contextlib.suppress(OSError):
+        dump()
+
+
+def maybe_dump():
+    # one dump at most every METRICS_DUMP_INTERVAL seconds, shortly after the values changed
+    if not METRICS_DIR:
+        return
+    with _lock:
+        if _dump_timer[0] is None:
+            _dump_timer[0] = threading.Timer(METRICS_DUMP_INTERVAL, _timed_dump)
+            _dump_timer[0].daemon = True
+            _dump_timer[0].start()
+
+
+atexit.register(dump)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def load_dumps():
+    # snapshots of the other running processes, dumps of finished ones are dropped
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return []
+    dumps = []
+    for entry in os.scandir(METRICS_DIR):
+        pid, extension = os.path.splitext(entry.name)
+        if extension != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        if not _process_alive(int(pid)):
+            with contextlib.suppress(OSError):
+                os.remove(entry.path)
+            continue
+        try:
+            with open(entry.path) as f:
+                dumps.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return dumps
+
+
+def render():
+    merged = defaultdict(dict)
+    for dumped in [snapshot()] + load_dumps():
+        for name, values in dumped.items():
+            metric = _registry.get(name)
+            if metric is None:
+                continue
+            for key, value in values:
+                key = tuple(key)
+                # dumped by a process running older code with other labels
+                if len(key) != len(metric.labels):
+                    continue
+                merged[name][key] = metric.merge(merged[name].get(key, metric.empty()), value)
+    lines = []
+    for name, metric in sorted(_registry.items()):
+        lines.append(f'# HELP {name} {metric.description}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        for key, value in sorted(merged[name].items()):
+            lines.extend(metric.format(key, value))
+    return '\n'.join(lines) + '\n'
+
+
+view_seconds = Histogram(
+    'client_view_duration_seconds', 'Time to build the response of a view', ('view', 'method', 'status')
+)
+view_queries = Histogram('client_view_sql_queries', 'SQL queries run by one request', ('view',), _count_buckets)
+peer_seconds = Histogram(
+    'client_peer_request_duration_seconds', 'Requests to other clients and the server', ('operation',)
+)
+peer_errors = Counter(
+    'client_peer_request_errors_total', 'Failed requests to other clients and the server', ('operation',)
+)
+outer_search_seconds = Histogram('client_outer_search_duration_seconds', 'Whole search among other clients')
+peer_searches_skipped = Counter(
+    'client_peer_searches_skipped_total', 'Searches not sent because the summary of the peer ruled them out'
+)
+hash_seconds = Histogram('client_hash_duration_seconds', 'Time to hash one file')
+hashed_bytes = Counter('client_hashed_bytes_total', 'Bytes read for hashing')
+cache_hits = Counter('client_cache_hits_total', 'Answers and hashes found in the caches', ('cache',))
+cache_misses = Counter('client_cache_misses_total', 'Answers and hashes missing from the caches', ('cache',))
+transfer_bytes = Counter(
+    'client_transfer_bytes_total', 'File bytes sent to and loaded from other clients', ('direction',)
+)
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+from django.db import connection
+
+from client_app import metrics
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks the instance as a coroutine function for Django, like MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        self.record(request, response, start)
+        metrics.view_queries.observe(queries[0], view=self.get_view_name(request))
+        return response
+
+    async def __acall__(self, request):
+        # queries of async views run in other threads and are not counted
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, start)
+        return response
+
+    def get_view_name(self, request):
+        return request.resolver_match.view_name if request.resolver_match else 'unresolved'
+
+    def record(self, request, response, start):
+        # streamed bodies are sent later and not included
+        elapsed = time.perf_counter() - start
+        metrics.view_seconds.observe(
+            elapsed, view=self.get_view_name(request), method=request.method, status=response.status_code
+        )
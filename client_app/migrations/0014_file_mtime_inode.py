@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0013_auto_20200801_1823'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='inode',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='mtime',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='size',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0014_file_mtime_inode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageScan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(default='queued', max_length=20)),
+                ('files_seen', models.BigIntegerField(default=0)),
+                ('files_to_hash', models.BigIntegerField(default=0)),
+                ('files_hashed', models.BigIntegerField(default=0)),
+                ('bytes_to_hash', models.BigIntegerField(default=0)),
+                ('bytes_hashed', models.BigIntegerField(default=0)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('storage', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='scan', to='client_app.storage')),
+            ],
+        ),
+    ]
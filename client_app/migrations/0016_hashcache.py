@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0015_storagescan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HashCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('inode', models.BigIntegerField()),
+                ('device', models.BigIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.BigIntegerField()),
+                ('file_hash', models.CharField(max_length=1000)),
+                ('last_seen', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='hashcache',
+            constraint=models.UniqueConstraint(fields=('inode', 'device', 'size', 'mtime'), name='hash_cache_identity'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0016_hashcache'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['hidden', 'storage'], name='file_hidden_storage'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['name'], name='file_name'),
+        ),
+    ]
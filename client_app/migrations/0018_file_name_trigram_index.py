@@ -0,0 +1,31 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:36
+
+from django.db import migrations
+
+
+def create_trigram_index(apps, schema_editor):
+    # only postgres gets an indexed substring search. The btree name index of other databases cannot serve
+    # icontains (LIKE '%x%'), there /search reads the whole table
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS file_name_trgm ON client_app_file USING gin (UPPER(name::text) gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS file_name_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0017_file_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
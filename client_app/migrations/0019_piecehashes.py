@@ -0,0 +1,26 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0018_file_name_trigram_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PieceHashes',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_hash', models.CharField(max_length=64)),
+                ('piece_size', models.IntegerField()),
+                ('pieces', models.TextField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='piecehashes',
+            constraint=models.UniqueConstraint(fields=('file_hash', 'piece_size'), name='piece_hashes_file'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0019_piecehashes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Transfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=255)),
+                ('file_hash', models.CharField(max_length=64)),
+                ('status', models.CharField(default='queued', max_length=20)),
+                ('size', models.BigIntegerField(null=True)),
+                ('bytes_done', models.BigIntegerField(default=0)),
+                ('error', models.CharField(blank=True, max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
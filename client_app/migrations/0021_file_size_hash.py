@@ -0,0 +1,17 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0020_transfer'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['size', 'file_hash'], name='file_size_hash'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+def drop_duplicate_settings(apps, schema_editor):
+    # concurrent get_or_create calls could store a name twice, the latest value wins
+    Settings = apps.get_model('client_app', 'Settings')
+    latest = {}
+    for setting_id, name in Settings.objects.order_by('id').values_list('id', 'name'):
+        latest[name] = setting_id
+    Settings.objects.exclude(id__in=latest.values()).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0021_file_size_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_settings, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='settings',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:58
+
+from django.db import migrations
+
+
+def remove_ping_task(apps, schema_editor):
+    # the server is pinged by manage.py heartbeat now
+    Task = apps.get_model('background_task', 'Task')
+    Task.objects.filter(task_name='client_app.tasks.ping_server').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('background_task', '0002_auto_20170927_1109'),
+        ('client_app', '0022_settings_name_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_ping_task, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0023_remove_ping_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='files_version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
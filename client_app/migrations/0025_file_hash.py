@@ -0,0 +1,17 @@
+# Generated by Django 3.1.14 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0024_storage_files_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['file_hash'], name='file_hash'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.1.14 on 2026-10-18 13:17
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_files(apps, schema_editor):
+    Storage = apps.get_model('client_app', 'Storage')
+    for storage in Storage.objects.annotate(count=Count('file')):
+        Storage.objects.filter(id=storage.id).update(files_count=storage.count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0025_file_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='files_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['name', 'id'], name='file_name_id'),
+        ),
+        migrations.AddIndex(
+            model_name='storage',
+            index=models.Index(fields=['date', 'id'], name='storage_date_id'),
+        ),
+        migrations.RemoveIndex(
+            model_name='file',
+            name='file_name',
+        ),
+        migrations.RunPython(count_files, migrations.RunPython.noop),
+    ]
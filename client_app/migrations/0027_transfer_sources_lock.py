@@ -0,0 +1,31 @@
+# Generated by Django 3.1.14 on 2026-10-18 13:47
+
+from django.db import migrations, models
+
+
+def drop_settings_lock(apps, schema_editor):
+    # download claims waited on this settings row before Lock existed
+    apps.get_model('client_app', 'Settings').objects.filter(name='download_claim_lock').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client_app', '0026_storage_files_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transfer',
+            name='sources',
+            field=models.TextField(blank=True),
+        ),
+        migrations.RunPython(drop_settings_lock, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,22 @@
+import os
+
 from django.db import models
+from django.utils import timezone
 
 
 class Storage(models.Model):
     path = models.CharField(max_length=4000)
     hidden = models.BooleanField(default=False)
     date = models.DateTimeField(auto_now_add=True)
+    # bumped whenever its files change, see name_index.touch
+    files_version = models.BigIntegerField(default=0)
+    # files in the storage, hidden ones included, moved by every name_index.touch
+    files_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'id'], name='storage_date_id'),
+        ]
 
 
 class File(models.Model):
@@ -13,9 +25,108 @@ class File(models.Model):
     file_hash = models.CharField(max_length=1000)
     storage = models.ForeignKey(Storage, on_delete=models.CASCADE)
     hidden = models.BooleanField(default=False)
-    size = models.IntegerField(null=True)
+    size = models.BigIntegerField(null=True)
+    mtime = models.BigIntegerField(null=True)
+    inode = models.BigIntegerField(null=True)
+
+    class Meta:
+        # name search itself (icontains) is served by a trigram index on postgres only, see migration 0018.
+        # Other databases read the whole table for it, the name index below helps ordering and exact names only
+        indexes = [
+            models.Index(fields=['hidden', 'storage'], name='file_hidden_storage'),
+            # serves lookups by name and the (name, id) pages of LocalFiles and /search
+            models.Index(fields=['name', 'id'], name='file_name_id'),
+            models.Index(fields=['size', 'file_hash'], name='file_size_hash'),
+            models.Index(fields=['file_hash'], name='file_hash'),
+        ]
+
+    def matches_stat(self, stat):
+        # the stored hash only describes the file while it is unchanged since the last scan
+        return bool(self.file_hash) and stat.st_size == self.size and stat.st_mtime_ns == self.mtime
+
+    def get_unchanged_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat if self.matches_stat(stat) else None
 
 
 class Settings(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
     value = models.CharField(max_length=255)
+
+
+class StorageScan(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    storage = models.OneToOneField(Storage, on_delete=models.CASCADE, related_name='scan')
+    status = models.CharField(max_length=20, default=QUEUED)
+    files_seen = models.BigIntegerField(default=0)
+    files_to_hash = models.BigIntegerField(default=0)
+    files_hashed = models.BigIntegerField(default=0)
+    bytes_to_hash = models.BigIntegerField(default=0)
+    bytes_hashed = models.BigIntegerField(default=0)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    def eta(self):
+        # seconds left, estimated from the hashing rate so far
+        if self.status != self.RUNNING or not self.started or not self.bytes_hashed:
+            return None
+        elapsed = (timezone.now() - self.started).total_seconds()
+        return int((self.bytes_to_hash - self.bytes_hashed) * elapsed / self.bytes_hashed)
+
+
+class HashCache(models.Model):
+    # content hashes by file identity, kept when files or storages are removed
+    inode = models.BigIntegerField()
+    device = models.BigIntegerField()
+    size = models.BigIntegerField()
+    mtime = models.BigIntegerField()
+    file_hash = models.CharField(max_length=1000)
+    last_seen = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['inode', 'device', 'size', 'mtime'], name='hash_cache_identity'),
+        ]
+
+
+class PieceHashes(models.Model):
+    # sha256 of every piece of a file, concatenated hex digests
+    file_hash = models.CharField(max_length=64)
+    piece_size = models.IntegerField()
+    pieces = models.TextField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file_hash', 'piece_size'], name='piece_hashes_file'),
+        ]
+
+
+class Transfer(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    ip = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    file_hash = models.CharField(max_length=64)
+    # every client a running download loads from, ip included, space separated
+    sources = models.TextField(blank=True)
+    status = models.CharField(max_length=20, default=QUEUED)
+    size = models.BigIntegerField(null=True)
+    bytes_done = models.BigIntegerField(default=0)
+    error = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class Lock(models.Model):
+    # rows writers wait for each other on with select_for_update, see tasks.claim_transfer
+    name = models.CharField(max_length=255, unique=True)
@@ -0,0 +1,314 @@
+import heapq
+import logging
+import sys
+import threading
+import time
+from array import array
+
+from django.db import DatabaseError, close_old_connections
+from django.db.models import F
+
+from client.settings import NAME_INDEX_ENABLED, NAME_INDEX_REFRESH
+from client_app.models import File, Storage
+
+logger = logging.getLogger(__name__)
+
+_digest_size = 32
+_no_digest = bytes(_digest_size)
+_no_slots = array('q')
+
+# the ready index of this process, None until the first build finished
+_index = None
+_started = threading.Lock()
+
+
+def trigrams(text):
+    return {text[start:start + 3] for start in range(len(text) - 2)}
+
+
+def pack_hash(file_hash):
+    # sha256 hex digests are kept as 32 raw bytes, zeros stand for a file not hashed yet
+    try:
+        digest = bytes.fromhex(file_hash)
+    except ValueError:
+        return _no_digest
+    return digest if len(digest) == _digest_size else _no_digest
+
+
+class NameIndex:
+    # shared files in parallel arrays, one slot per file. Only the sync thread writes: new slots stay invisible
+    # until the (name, id) order including them is published, slots of removed or changed files stay dead
+    # until compaction
+    def __init__(self):
+        self.ids = array('q')
+        self.sizes = array('q')
+        self.storage_ids = array('q')
+        self.digests = bytearray()
+        self.alive = bytearray()
+        self.names = []
+        # lower case names, the same object as the name when it has no capitals
+        self.folded = []
+        # trigram of the folded name -> slots
+        self.postings = {}
+        self.slots_by_storage = {}
+        # visible slots ordered by (name, id)
+        self.order = array('q')
+        # storage id -> files_version the loaded files belong to
+        self.versions = {}
+        self.hidden_storages = set()
+        self.dead = 0
+        self.build_seconds = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, rows):
+        first = len(self.ids)
+        for file_id, name, size, file_hash, storage_id in rows:
+            slot = len(self.ids)
+            name = sys.intern(name)
+            folded = sys.intern(name.lower())
+            self.ids.append(file_id)
+            self.sizes.append(-1 if size is None else size)
+            self.storage_ids.append(storage_id)
+            self.digests += pack_hash(file_hash)
+            self.alive.append(0)
+            self.names.append(name)
+            self.folded.append(folded)
+            for gram in trigrams(folded):
+                self.postings.setdefault(gram, array('q')).append(slot)
+            self.slots_by_storage.setdefault(storage_id, array('q')).append(slot)
+        return range(first, len(self.ids))
+
+    def sort_key(self, slot):
+        return self.names[slot], self.ids[slot]
+
+    def same_row(self, slot, row):
+        _, name, size, file_hash, _ = row
+        return (
+            self.names[slot] == name and self.sizes[slot] == (-1 if size is None else size)
+            and self.digests[slot * _digest_size:(slot + 1) * _digest_size] == pack_hash(file_hash)
+        )
+
+    def merged_order(self, added, dropped):
+        # dropped slots are in the order. A few changes are placed by binary search and the new order is put
+        # together from slices of the old one, only big changes sort everything again
+        order = self.order
+        if len(added) + len(dropped) > len(order) // 4:
+            dropped = set(dropped)
+            return array('q', sorted([slot for slot in order if slot not in dropped] + list(added), key=self.sort_key))
+        # a new slot goes before the slot at its position, a dropped slot is the one at its position
+        edits = sorted(
+            [(self.seek(order, self.sort_key(slot)), 0, self.sort_key(slot), slot) for slot in added]
+            + [(self.seek(order, self.sort_key(slot)) - 1, 1, self.sort_key(slot), slot) for slot in dropped]
+        )
+        merged = array('q')
+        last = 0
+        for position, is_dropped, _, slot in edits:
+            merged.extend(order[last:position])
+            if is_dropped:
+                last = position + 1
+            else:
+                merged.append(slot)
+                last = position
+        merged.extend(order[last:])
+        return merged
+
+    def publish(self, added, dropped, versions, hidden_storages):
+        # the new order is made outside the lock
+        order = self.merged_order(added, dropped) if added or dropped else self.order
+        with self.lock:
+            for slot in dropped:
+                self.alive[slot] = 0
+            for slot in added:
+                self.alive[slot] = 1
+            self.order = order
+            self.versions = versions
+            self.hidden_storages = hidden_storages
+        self.dead += len(dropped)
+
+    def compacted(self):
+        # a fresh index without the dead slots, built while this one keeps answering
+        index = NameIndex()
+        index.publish(
+            index.add(self.get_row(slot) for slot in self.order if self.alive[slot]),
+            (),
+            self.versions,
+            self.hidden_storages
+        )
+        index.build_seconds = self.build_seconds
+        return index
+
+    def get_hash(self, slot):
+        digest = bytes(self.digests[slot * _digest_size:(slot + 1) * _digest_size])
+        return '' if digest == _no_digest else digest.hex()
+
+    def get_row(self, slot):
+        size = self.sizes[slot]
+        return self.ids[slot], self.names[slot], None if size < 0 else size, self.get_hash(slot), self.storage_ids[slot]
+
+    def sync(self):
+        # one small query while nothing changed. Files of storages whose files_version moved are read again and
+        # compared with their slots, only new, changed and removed files change the index
+        start = time.perf_counter()
+        storages = list(Storage.objects.values_list('id', 'hidden', 'files_version'))
+        versions = {storage_id: version for storage_id, _, version in storages}
+        hidden_storages = {storage_id for storage_id, hidden, _ in storages if hidden}
+        changed = [storage_id for storage_id, version in versions.items() if self.versions.get(storage_id) != version]
+        if not changed and versions == self.versions:
+            if hidden_storages != self.hidden_storages:
+                with self.lock:
+                    self.hidden_storages = hidden_storages
+            if self.build_seconds is None:
+                self.build_seconds = time.perf_counter() - start
+            return changed
+        # everything is read before the index changes, a database error leaves it as it was
+        loaded = {
+            storage_id: list(
+                File.objects
+                .filter(storage_id=storage_id, hidden=False)
+                .exclude(file_hash='')
+                .values_list('id', 'name', 'size', 'file_hash', 'storage_id')
+            )
+            for storage_id in changed
+        }
+        dropped = []
+        for storage_id in self.versions:
+            if storage_id not in versions:
+                dropped.extend(self.slots_by_storage.pop(storage_id, _no_slots))
+        added = []
+        for storage_id, rows in loaded.items():
+            slots = {self.ids[slot]: slot for slot in self.slots_by_storage.get(storage_id, _no_slots)}
+            kept = array('q')
+            new_rows = []
+            for row in rows:
+                slot = slots.pop(row[0], None)
+                if slot is not None and self.same_row(slot, row):
+                    kept.append(slot)
+                    continue
+                if slot is not None:
+                    dropped.append(slot)
+                new_rows.append(row)
+            dropped.extend(slots.values())
+            new_slots = self.add(new_rows)
+            added.extend(new_slots)
+            kept.extend(new_slots)
+            self.slots_by_storage[storage_id] = kept
+        self.publish(added, dropped, versions, hidden_storages)
+        if self.build_seconds is None:
+            self.build_seconds = time.perf_counter() - start
+        return changed
+
+    def seek(self, order, cursor):
+        # the first position after the cursor
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.sort_key(order[middle]) <= cursor:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def search(self, search_str, fields, cursor=None, count=None):
+        # the same rows as search.search_rows: shared files containing search_str ordered by (name, id)
+        # names only compare with names, search.decode_cursor checks cursors coming from requests
+        if cursor and not (isinstance(cursor[0], str) and isinstance(cursor[1], int)):
+            raise ValueError('Wrong cursor')
+        query = search_str.lower()
+        cursor = tuple(cursor) if cursor else None
+        with self.lock:
+            order, alive, hidden = self.order, self.alive, self.hidden_storages
+            folded, storage_ids = self.folded, self.storage_ids
+            start = self.seek(order, cursor) if cursor else 0
+            grams = trigrams(query)
+            # the rarest trigram narrows the candidates, the substring check does the rest
+            candidates = min((self.postings.get(gram, _no_slots) for gram in grams), key=len) if grams else None
+            if candidates is None or count is not None and len(candidates) * 4 > len(order):
+                # text in most names: walk in order and stop after count files, like the database does
+                slots = []
+                for position in range(start, len(order)):
+                    slot = order[position]
+                    if query in folded[slot] and storage_ids[slot] not in hidden:
+                        slots.append(slot)
+                        if len(slots) == count:
+                            break
+            else:
+                matched = [
+                    slot for slot in candidates
+                    if alive[slot] and query in folded[slot] and storage_ids[slot] not in hidden
+                    and (cursor is None or self.sort_key(slot) > cursor)
+                ]
+                if count is None:
+                    slots = sorted(matched, key=self.sort_key)
+                else:
+                    slots = heapq.nsmallest(count, matched, key=self.sort_key)
+            rows = []
+            for slot in slots:
+                file_id, name, size, file_hash, _ = self.get_row(slot)
+                row = {'id': file_id, 'name': name, 'size': size, 'file_hash': file_hash}
+                rows.append({field: row[field] for field in dict.fromkeys(['id', 'name', *fields])})
+            return rows
+
+    def memory_bytes(self):
+        # containers plus the distinct strings, interned names shared between files are counted once
+        total = sum(
+            sys.getsizeof(container) for container in (
+                self.ids, self.sizes, self.storage_ids, self.digests, self.alive, self.names, self.folded,
+                self.postings, self.order
+            )
+        )
+        total += sum(sys.getsizeof(gram) + sys.getsizeof(slots) for gram, slots in self.postings.items())
+        total += sum(sys.getsizeof(slots) for slots in self.slots_by_storage.values())
+        strings = {id(text): text for text in self.names + self.folded}
+        return total + sum(sys.getsizeof(text) for text in strings.values())
+
+    def __str__(self):
+        return (
+            f'{len(self)} files, {len(self.postings)} trigrams, {self.memory_bytes() / 1048576:.1f} MB, '
+            f'built in {self.build_seconds or 0:.2f}s'
+        )
+
+
+def get_index():
+    return _index
+
+
+def set_index(index):
+    global _index
+    _index = index
+
+
+def touch(storage_id, added=0, deleted=0):
+    # files of the storage changed, the indexes of running web servers reload it on their next sync.
+    # files_count moves by what the caller added and deleted, counting the storage again would cost a scan of it
+    Storage.objects.filter(id=storage_id).update(
+        files_version=F('files_version') + 1,
+        files_count=F('files_count') + added - deleted
+    )
+
+
+def run(index, refresh=NAME_INDEX_REFRESH):
+    while True:
+        try:
+            index.sync()
+        except DatabaseError:
+            logger.exception('Cannot refresh the name index')
+        finally:
+            close_old_connections()
+        if index.dead > len(index):
+            index = index.compacted()
+            if get_index() is not None:
+                set_index(index)
+        if get_index() is None and index.build_seconds is not None:
+            logger.info('Name index ready: %s', index)
+            set_index(index)
+        time.sleep(refresh)
+
+
+def start():
+    # called by the web server entry points, searches go to the database until the first build is done
+    if not NAME_INDEX_ENABLED or not _started.acquire(blocking=False):
+        return
+    threading.Thread(target=run, args=(NameIndex(),), name='name-index', daemon=True).start()
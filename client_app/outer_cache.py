@@ -0,0 +1,53 @@
+import hashlib
+
+from django.core.cache import caches
+
+from client_app import metrics
+
+_version_key = 'outer_version'
+
+
+def get_cache():
+    return caches['outer']
+
+
+def get_version():
+    return get_cache().get_or_set(_version_key, 1, None)
+
+
+def invalidate():
+    # bumping the version orphans every cached entry, the cache evicts them later
+    try:
+        get_cache().incr(_version_key)
+    except ValueError:
+        get_cache().set(_version_key, 2, None)
+
+
+def search_key(address, search_str):
+    return f'search:{address}:{hashlib.sha256(search_str.encode()).hexdigest()}'
+
+
+def get_or_fetch(key, fetch, ttl):
+    # fetch() errors are not cached, the next call simply tries again
+    version = get_version()
+    value = get_cache().get(key, version=version)
+    if value is not None:
+        metrics.cache_hits.inc(cache=key.split(':', 1)[0])
+        return value
+    metrics.cache_misses.inc(cache=key.split(':', 1)[0])
+    value = fetch()
+    get_cache().set(key, value, ttl, version=version)
+    return value
+
+
+async def get_or_fetch_async(key, fetch, ttl):
+    # the same for coroutines, the local memory cache does not block
+    version = get_version()
+    value = get_cache().get(key, version=version)
+    if value is not None:
+        metrics.cache_hits.inc(cache=key.split(':', 1)[0])
+        return value
+    metrics.cache_misses.inc(cache=key.split(':', 1)[0])
+    value = await fetch()
+    get_cache().set(key, value, ttl, version=version)
+    return value
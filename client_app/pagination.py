@@ -0,0 +1,144 @@
+import base64
+import json
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Q
+from django.http import Http404
+
+_integer_fields = ('AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField')
+
+
+class KeysetError(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def field_name(field):
+    return field.lstrip('-')
+
+
+def reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+
+
+def decode_cursor(model, ordering, cursor):
+    # the values are checked by the model fields, a broken cursor never reaches the database
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise ValueError
+        decoded = []
+        for field, value in zip(ordering, values):
+            # ids are JSON numbers, names and dates strings, as encode_cursor writes them
+            model_field = model._meta.get_field(field_name(field))
+            integer = model_field.get_internal_type() in _integer_fields
+            if isinstance(value, bool) or not isinstance(value, int if integer else str):
+                raise ValueError
+            decoded.append(model_field.to_python(value))
+        return decoded
+    except (ValueError, TypeError, ValidationError):
+        raise KeysetError('Wrong cursor')
+
+
+def seek(queryset, ordering, values):
+    # rows after the cursor in (ordering) order, a field with '-' goes down. The extra range on the first field
+    # lets the database start from the cursor in the index instead of reading all rows before it
+    lookups = ['lt' if field.startswith('-') else 'gt' for field in ordering]
+    names = [field_name(field) for field in ordering]
+    condition = Q()
+    for position in reversed(range(len(ordering))):
+        equal = {name: value for name, value in zip(names[:position], values)}
+        condition = Q(**equal, **{f'{names[position]}__{lookups[position]}': values[position]}) | condition
+    return queryset.filter(condition, **{f'{names[0]}__{lookups[0]}e': values[0]})
+
+
+def estimate_rows(model):
+    # the planner statistics on postgres, None elsewhere or before the table was ever analyzed
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] > 0 else None
+
+
+class KeysetPage:
+    def __init__(self, rows, ordering, has_previous, has_next):
+        self.object_list = rows
+        self.ordering = ordering
+        # an empty page has no row to ask its neighbours by
+        self.has_previous = has_previous and bool(rows)
+        self.has_next = has_next and bool(rows)
+
+    def cursor(self, row):
+        return encode_cursor([getattr(row, field_name(field)) for field in self.ordering])
+
+    def previous_cursor(self):
+        return self.cursor(self.object_list[0])
+
+    def next_cursor(self):
+        return self.cursor(self.object_list[-1])
+
+
+def get_page(queryset, ordering, size, after=None, before=None, last=False):
+    # ordering ends with a unique field, one row more than size tells whether there is more
+    if before is not None or last:
+        rows = queryset.order_by(*reverse_ordering(ordering))
+        if before is not None:
+            rows = seek(rows, reverse_ordering(ordering), before)
+        rows = list(rows[:size + 1])
+        return KeysetPage(rows[:size][::-1], ordering, len(rows) > size, before is not None)
+    rows = queryset.order_by(*ordering)
+    if after is not None:
+        rows = seek(rows, ordering, after)
+    rows = list(rows[:size + 1])
+    return KeysetPage(rows[:size], ordering, after is not None, len(rows) > size)
+
+
+class KeysetPaginationMixin:
+    # replaces paginate_by's COUNT(*) and OFFSET: pages are asked by the first or last row of the neighbour page,
+    # so the last page costs as much as the first. The ordering must end with a unique field
+    page_size = 10
+    page_params = ('page', 'after', 'before', 'last')
+
+    def paginate_queryset(self, queryset, page_size):
+        ordering = self.get_ordering()
+        params = self.request.GET
+        try:
+            after = decode_cursor(queryset.model, ordering, params['after']) if params.get('after') else None
+            before = decode_cursor(queryset.model, ordering, params['before']) if params.get('before') else None
+        except KeysetError as e:
+            raise Http404(str(e))
+        page = get_page(queryset, ordering, page_size, after, before, last=params.get('last') == '1')
+        return None, page, page.object_list, page.has_previous or page.has_next
+
+    def get_paginate_by(self, queryset):
+        return self.page_size
+
+    def get_page_query(self, **page_params):
+        query = self.request.GET.copy()
+        for name in self.page_params:
+            query.pop(name, None)
+        query.update(page_params)
+        return query.urlencode()
+
+    def get_approximate_count(self):
+        return None
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        page = context['page_obj']
+        context['approximate_count'] = self.get_approximate_count()
+        context['first_query'] = self.get_page_query()
+        context['last_query'] = self.get_page_query(last='1')
+        if page.has_previous:
+            context['previous_query'] = self.get_page_query(before=page.previous_cursor())
+        if page.has_next:
+            context['next_query'] = self.get_page_query(after=page.next_cursor())
+        return context
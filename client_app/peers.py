@@ -0,0 +1,336 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+
+import httpx
+import requests
+
+from client.settings import (
+    SERVER_PORT, CLIENT_PORT, ONLINE_CACHE_TTL, PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT, PEER_SEARCH_DEADLINE,
+    PEER_SEARCH_WORKERS, PEER_SEARCH_LIMIT, PEER_SEARCH_CACHE_TTL, HASH_LOOKUP_MAX
+)
+from client_app import async_http_client, http_client, metrics, outer_cache, summary
+from client_app.serializers import OuterFileSerializer
+
+
+class ServerError(Exception):
+    pass
+
+
+def fetch_online_clients(server, token):
+    try:
+        with metrics.time_peer(server, 'online'):
+            response = http_client.get(
+                f'http://{server}:{SERVER_PORT}/online', headers={'Authorization': f'TOKEN {token}'}
+            )
+    except requests.exceptions.RequestException:
+        metrics.peer_errors.inc(operation='online')
+        raise ServerError(f'Cannot connect to {server}')
+    if response.status_code != 200:
+        raise ServerError(f'Error connecting to server: {response.status_code}')
+    if not response.json() or 'available' not in response.json():
+        raise ServerError('Server returned empty response.')
+    return response.json()['available']
+
+
+def get_online_clients(server, token):
+    return outer_cache.get_or_fetch(f'online:{server}', lambda: fetch_online_clients(server, token), ONLINE_CACHE_TTL)
+
+
+async def fetch_online_clients_async(server, token):
+    try:
+        with metrics.time_peer(server, 'online'):
+            response = await async_http_client.get_client().get(
+                f'http://{server}:{SERVER_PORT}/online', headers={'Authorization': f'TOKEN {token}'}
+            )
+    except httpx.HTTPError:
+        metrics.peer_errors.inc(operation='online')
+        raise ServerError(f'Cannot connect to {server}')
+    if response.status_code != 200:
+        raise ServerError(f'Error connecting to server: {response.status_code}')
+    if not response.json() or 'available' not in response.json():
+        raise ServerError('Server returned empty response.')
+    return response.json()['available']
+
+
+async def get_online_clients_async(server, token):
+    return await outer_cache.get_or_fetch_async(
+        f'online:{server}', lambda: fetch_online_clients_async(server, token), ONLINE_CACHE_TTL
+    )
+
+
+def clean_peer_file(address, file):
+    found_file = OuterFileSerializer(data=file)
+    if not found_file.is_valid():
+        return None
+    result_dict = found_file.data
+    result_dict['url'] = address
+    return result_dict
+
+
+def iter_peer_rows(response):
+    if response.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+        for line in response.iter_lines():
+            row = json.loads(line) if line else {}
+            # the closing line only holds the cursor of the next page
+            if 'name' in row:
+                yield row
+    else:
+        # peers without streaming support answer with one document
+        yield from response.json()['files']
+
+
+def search_peer(address, search_str, limit=PEER_SEARCH_LIMIT):
+    with metrics.time_peer(address, 'search'):
+        try:
+            return _search_peer(address, search_str, limit)
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            metrics.peer_errors.inc(operation='search')
+            raise
+
+
+def _search_peer(address, search_str, limit):
+    response = http_client.get(
+        f'http://{address}:{CLIENT_PORT}/search',
+        params={'search_str': search_str, 'limit': limit, 'stream': '1'},
+        timeout=(PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT),
+        stream=True
+    )
+    with response:
+        response.raise_for_status()
+        found_files = []
+        for file in iter_peer_rows(response):
+            found_file = clean_peer_file(address, file)
+            if found_file is not None:
+                found_files.append(found_file)
+            # old peers ignore the limit
+            if len(found_files) >= limit:
+                break
+    return found_files
+
+
+async def aiter_peer_rows(response):
+    if response.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+        async for line in response.aiter_lines():
+            row = json.loads(line) if line else {}
+            if 'name' in row:
+                yield row
+    else:
+        await response.aread()
+        for row in response.json()['files']:
+            yield row
+
+
+async def search_peer_async(address, search_str, limit=PEER_SEARCH_LIMIT):
+    with metrics.time_peer(address, 'search'):
+        try:
+            return await _search_peer_async(address, search_str, limit)
+        except (httpx.HTTPError, ValueError, KeyError, TypeError):
+            metrics.peer_errors.inc(operation='search')
+            raise
+
+
+async def _search_peer_async(address, search_str, limit):
+    found_files = []
+    async with async_http_client.get_client().stream(
+        'GET',
+        f'http://{address}:{CLIENT_PORT}/search',
+        params={'search_str': search_str, 'limit': limit, 'stream': '1'},
+        timeout=httpx.Timeout(PEER_READ_TIMEOUT, connect=PEER_CONNECT_TIMEOUT)
+    ) as response:
+        response.raise_for_status()
+        async for file in aiter_peer_rows(response):
+            found_file = clean_peer_file(address, file)
+            if found_file is not None:
+                found_files.append(found_file)
+            if len(found_files) >= limit:
+                break
+    return found_files
+
+
+def search_peer_cached(address, search_str):
+    return outer_cache.get_or_fetch(
+        outer_cache.search_key(address, search_str),
+        lambda: search_peer(address, search_str),
+        PEER_SEARCH_CACHE_TTL
+    )
+
+
+class PeerSearch:
+    # asks all peers at once and yields (address, files) in the order the answers arrive. Peers whose summary
+    # rules the name out are skipped, see summary.plan
+    def __init__(self, addresses, search_str, deadline=PEER_SEARCH_DEADLINE, workers=PEER_SEARCH_WORKERS,
+                 use_cache=True):
+        self.addresses = list(addresses)
+        self.search_str = search_str
+        self.search = search_peer_cached if use_cache else search_peer
+        self.deadline = deadline
+        self.workers = workers
+        self.timed_out = []
+        self.failed = []
+
+    def checked_search(self, address, items):
+        # None when the checked summary rules the name out
+        if summary.check_peer(address, items):
+            return self.search(address, self.search_str)
+        return None
+
+    def __iter__(self):
+        items = summary.name_items(self.search_str)
+        ask, check, load = summary.plan(self.addresses, items)
+        if not ask and not check and not load:
+            return
+        executor = ThreadPoolExecutor(max_workers=min(self.workers, len(ask) + len(check) + len(load)))
+        futures = {executor.submit(self.search, address, self.search_str): address for address in ask}
+        futures.update({executor.submit(self.checked_search, address, items): address for address in check})
+        # nobody waits for these
+        for address in load:
+            executor.submit(summary.refresh_peer, address)
+        finish_by = time.monotonic() + self.deadline
+        try:
+            for future in as_completed(futures, timeout=max(finish_by - time.monotonic(), 0)):
+                address = futures.pop(future)
+                try:
+                    files = future.result()
+                    if files is not None:
+                        yield address, files
+                except requests.exceptions.Timeout:
+                    self.timed_out.append(address)
+                except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+                    self.failed.append(address)
+        except TimeoutError:
+            self.timed_out.extend(futures.values())
+        finally:
+            # do not wait for hung peers, their sockets time out on their own
+            executor.shutdown(wait=False)
+
+
+def lookup_peer_hashes(address, hashes):
+    # {file_hash: file} of the hashes the peer shares, HASH_LOOKUP_MAX hashes per request
+    found = {}
+    with metrics.time_peer(address, 'hashes'):
+        try:
+            for start in range(0, len(hashes), HASH_LOOKUP_MAX):
+                response = http_client.post(
+                    f'http://{address}:{CLIENT_PORT}/hashes',
+                    json={'hashes': hashes[start:start + HASH_LOOKUP_MAX]},
+                    timeout=(PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT)
+                )
+                response.raise_for_status()
+                for file in response.json()['files']:
+                    found_file = clean_peer_file(address, file)
+                    if found_file is not None:
+                        found[found_file['file_hash']] = found_file
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            metrics.peer_errors.inc(operation='hashes')
+            raise
+    return found
+
+
+class HashLookup:
+    # asks every peer at once which of the hashes it shares, hashes its summary rules out are not sent to it
+    def __init__(self, addresses, hashes, deadline=PEER_SEARCH_DEADLINE, workers=PEER_SEARCH_WORKERS):
+        self.addresses = list(addresses)
+        self.hashes = list(dict.fromkeys(hashes))
+        self.deadline = deadline
+        self.workers = workers
+        self.timed_out = []
+        self.failed = []
+        # peers without /hashes, they only answer name searches
+        self.unsupported = []
+
+    def get_wanted(self, known):
+        return self.hashes if known is None else [
+            file_hash for file_hash in self.hashes if known.might_have(summary.hash_items(file_hash))
+        ]
+
+    def checked_lookup(self, address):
+        # like PeerSearch, an outdated summary only leaves hashes out after its version check
+        since = time.monotonic()
+        summary.refresh_peer(address)
+        hashes = self.get_wanted(summary.get_fresh(address, since))
+        return lookup_peer_hashes(address, hashes) if hashes else {}
+
+    def run(self):
+        # {file_hash: [the file at every peer sharing it]}
+        found = {}
+        if not self.hashes or not self.addresses:
+            return found
+        wanted, check = {}, []
+        for address in self.addresses:
+            hashes = self.get_wanted(summary.get_known(address))
+            if len(hashes) < len(self.hashes) and summary.get_fresh(address) is None:
+                check.append(address)
+            elif hashes:
+                wanted[address] = hashes
+        load = [address for address in self.addresses if summary.needs_load(address)]
+        executor = ThreadPoolExecutor(max_workers=min(self.workers, len(self.addresses) + len(load)))
+        futures = {
+            executor.submit(lookup_peer_hashes, address, hashes): address for address, hashes in wanted.items()
+        }
+        futures.update({executor.submit(self.checked_lookup, address): address for address in check})
+        for address in load:
+            executor.submit(summary.refresh_peer, address)
+        try:
+            for future in as_completed(futures, timeout=self.deadline):
+                address = futures.pop(future)
+                try:
+                    for file_hash, file in future.result().items():
+                        found.setdefault(file_hash, []).append(file)
+                except requests.exceptions.Timeout:
+                    self.timed_out.append(address)
+                except requests.exceptions.HTTPError as e:
+                    if e.response.status_code in (404, 405):
+                        self.unsupported.append(address)
+                    else:
+                        self.failed.append(address)
+                except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+                    self.failed.append(address)
+        except TimeoutError:
+            self.timed_out.extend(futures.values())
+        finally:
+            executor.shutdown(wait=False)
+        return found
+
+
+async def search_peers_async(addresses, search_str, deadline=PEER_SEARCH_DEADLINE, use_cache=True):
+    # PeerSearch on the event loop: ({address: files}, timed out addresses, failed addresses)
+    async def search(address):
+        if not use_cache:
+            return await search_peer_async(address, search_str)
+        return await outer_cache.get_or_fetch_async(
+            outer_cache.search_key(address, search_str),
+            lambda: search_peer_async(address, search_str),
+            PEER_SEARCH_CACHE_TTL
+        )
+
+    async def checked_search(address):
+        if await summary.check_peer_async(address, items):
+            return await search(address)
+        return None
+
+    items = summary.name_items(search_str)
+    ask, check, load = summary.plan(list(addresses), items)
+    summary.load_async(load)
+    tasks = {asyncio.ensure_future(search(address)): address for address in ask}
+    tasks.update({asyncio.ensure_future(checked_search(address)): address for address in check})
+    if not tasks:
+        return {}, [], []
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    results = {}
+    timed_out = [tasks[task] for task in pending]
+    failed = []
+    for task in done:
+        address = tasks[task]
+        try:
+            files = task.result()
+            if files is not None:
+                results[address] = files
+        except httpx.TimeoutException:
+            timed_out.append(address)
+        except (httpx.HTTPError, ValueError, KeyError, TypeError):
+            failed.append(address)
+    return results, timed_out, failed
@@ -0,0 +1,235 @@
+import logging
+import os
+import time
+from collections import namedtuple
+
+from django.db.models import Q
+
+from client_app import hash_cache, name_index
+from client_app.models import File, Storage
+
+logger = logging.getLogger(__name__)
+
+_batch_size = 1000
+_progress_save_interval = 2
+
+FileState = namedtuple('FileState', ['size', 'mtime', 'inode'])
+
+
+class ScanResult:
+    def __init__(self, storage):
+        self.storage = storage
+        self.seen = 0
+        self.added = 0
+        self.updated = 0
+        self.deleted = 0
+        self.unchanged = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.timings = {}
+
+    def __str__(self):
+        timings = ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.timings.items())
+        return (
+            f'{self.storage.path}: seen {self.seen}, added {self.added}, updated {self.updated}, '
+            f'deleted {self.deleted}, unchanged {self.unchanged}, '
+            f'hash cache {self.cache_hits} hits / {self.cache_misses} misses ({timings})'
+        )
+
+
+class _Timer:
+    def __init__(self, result, phase):
+        self.result = result
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.result.timings[self.phase] = time.perf_counter() - self.start
+
+
+class ScanProgress:
+    # keeps StorageScan counters current without saving on every file
+    def __init__(self, scan=None):
+        self.scan = scan
+        self.last_save = 0
+
+    def save(self, force=False):
+        if self.scan is None:
+            return
+        now = time.monotonic()
+        if force or now - self.last_save >= _progress_save_interval:
+            self.scan.save()
+            self.last_save = now
+
+    def walked(self):
+        if self.scan is not None:
+            self.scan.files_seen += 1
+            self.save()
+
+    def hashing(self, files, size):
+        if self.scan is not None:
+            self.scan.files_to_hash = files
+            self.scan.bytes_to_hash = size
+            self.save(force=True)
+
+    def hashed(self, size):
+        if self.scan is not None:
+            self.scan.files_hashed += 1
+            self.scan.bytes_hashed += size
+            self.save()
+
+
+def walk_files(root, skip_dirs=()):
+    # iterative scandir walk, yields (path, stat) without following directory symlinks
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except (PermissionError, FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in skip_dirs:
+                            stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
+
+
+def load_known_state(storage, paths=None):
+    # paths limits the rows to these files and everything below these directories
+    files = File.objects.filter(storage=storage)
+    if paths is not None:
+        condition = Q()
+        for path in paths:
+            condition |= Q(path=path) | Q(path__startswith=os.path.join(path, ''))
+        files = files.filter(condition)
+    known = {}
+    for file_id, path, size, mtime, inode, file_hash in (
+        files.values_list('id', 'path', 'size', 'mtime', 'inode', 'file_hash').iterator()
+    ):
+        # files indexed without a hash are hashed by the next scan
+        known[path] = (file_id, FileState(size, mtime, inode) if file_hash else None)
+    return known
+
+
+def stat_paths(paths, skip_dirs=()):
+    # like walk_files for a mix of files and directories, missing and skipped paths are left out
+    for path in paths:
+        if path in skip_dirs:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            yield from walk_files(path, skip_dirs)
+        elif os.path.isfile(path):
+            try:
+                yield path, os.stat(path)
+            except OSError:
+                continue
+
+
+def scan_storage(storage, skip_dirs=(), progress=None, paths=None):
+    # paths limits the scan to these files and directories inside the storage
+    progress = progress or ScanProgress()
+    result = ScanResult(storage)
+    if not os.path.isdir(storage.path):
+        # unmounted or removed storage - keep what we know about it
+        logger.warning('Storage %s is not available, skipping scan', storage.path)
+        return result
+
+    with _Timer(result, 'load'):
+        known = load_known_state(storage, paths)
+
+    with _Timer(result, 'walk'):
+        on_disk = {}
+        devices = {}
+        walked = walk_files(storage.path, skip_dirs) if paths is None else stat_paths(paths, skip_dirs)
+        for path, stat in walked:
+            on_disk[path] = FileState(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            devices[path] = stat.st_dev
+            progress.walked()
+    result.seen = len(on_disk)
+
+    to_create = []
+    to_update = []
+    with _Timer(result, 'hash'):
+        changed = []
+        for path, state in on_disk.items():
+            file_id, known_state = known.get(path, (None, None))
+            if known_state == state:
+                result.unchanged += 1
+            else:
+                changed.append((path, file_id, state))
+        progress.hashing(len(changed), sum(state.size for _, _, state in changed))
+
+        cache_counters = {'hits': 0, 'misses': 0}
+        hashes = hash_cache.cached_hash_files(
+            (
+                (path, hash_cache.CacheKey(state.inode, devices[path], state.size, state.mtime))
+                for path, _, state in changed
+            ),
+            cache_counters,
+        )
+        for (path, file_id, state), (_, file_hash) in zip(changed, hashes):
+            progress.hashed(state.size)
+            # file vanished or became unreadable between walk and hash
+            if file_hash is None:
+                continue
+            file_obj = File(
+                id=file_id,
+                path=path,
+                storage=storage,
+                name=os.path.basename(path),
+                file_hash=file_hash,
+                size=state.size,
+                mtime=state.mtime,
+                inode=state.inode,
+            )
+            if file_id is None:
+                to_create.append(file_obj)
+            else:
+                to_update.append(file_obj)
+        result.cache_hits = cache_counters['hits']
+        result.cache_misses = cache_counters['misses']
+    deleted_ids = [file_id for path, (file_id, _) in known.items() if path not in on_disk]
+
+    with _Timer(result, 'write'):
+        File.objects.bulk_create(to_create, batch_size=_batch_size)
+        File.objects.bulk_update(to_update, ['file_hash', 'size', 'mtime', 'inode'], batch_size=_batch_size)
+        deleted = 0
+        for start in range(0, len(deleted_ids), _batch_size):
+            deleted += File.objects.filter(id__in=deleted_ids[start:start + _batch_size]).delete()[0]
+        hash_cache.evict()
+    result.added = len(to_create)
+    result.updated = len(to_update)
+    result.deleted = len(deleted_ids)
+    if to_create or to_update or deleted_ids:
+        name_index.touch(storage.id, added=len(to_create), deleted=deleted)
+
+    progress.save(force=True)
+    logger.info('Scanned %s', result)
+    return result
+
+
+def get_nested_storage_paths(storage, storages):
+    # other storages inside this one are scanned on their own
+    prefix = os.path.join(storage.path, '')
+    return {
+        other.path.rstrip(os.sep) for other in storages
+        if other.path.startswith(prefix) and other.path.rstrip(os.sep) != storage.path.rstrip(os.sep)
+    }
+
+
+def get_parent_storages(storage, storages):
+    # storages this one lies inside, their scans skip its files
+    path = os.path.join(storage.path, '')
+    return [other for other in storages if other.id != storage.id and path.startswith(os.path.join(other.path, ''))]
+
+
+def scan_all_storages():
+    storages = list(Storage.objects.all())
+    return [scan_storage(storage, get_nested_storage_paths(storage, storages)) for storage in storages]
@@ -0,0 +1,104 @@
+import json
+
+from client.settings import SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT
+from client_app import name_index, pagination
+from client_app.models import File
+
+SEARCH_FIELDS = ('name', 'size', 'file_hash')
+
+
+class SearchError(ValueError):
+    pass
+
+
+def encode_cursor(row):
+    return pagination.encode_cursor([row['name'], row['id']])
+
+
+def decode_cursor(cursor):
+    # [name, id] with a string name and an integer id, anything else is a client error
+    try:
+        return tuple(pagination.decode_cursor(File, ['name', 'id'], cursor))
+    except pagination.KeysetError:
+        raise SearchError('Wrong "cursor"')
+
+
+def parse_search_params(params):
+    try:
+        limit = min(int(params.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+    except ValueError:
+        raise SearchError('"limit" must be a number')
+    if limit < 1:
+        raise SearchError('"limit" must be positive')
+    fields = [field for field in params.get('fields', '').split(',') if field] or list(SEARCH_FIELDS)
+    if not set(fields) <= set(SEARCH_FIELDS):
+        raise SearchError(f'"fields" must be some of: {", ".join(SEARCH_FIELDS)}')
+    cursor = decode_cursor(params['cursor']) if params.get('cursor') else None
+    return limit, fields, cursor
+
+
+def search_rows(search_str, fields, cursor=None):
+    # shared files ordered by (name, id), as plain dicts with the requested fields plus name and id.
+    # Files indexed without a hash are not shared until a scan adds it
+    queryset = (
+        File
+        .objects
+        .filter(
+            name__icontains=search_str,
+            hidden=False,
+            storage__hidden=False
+        )
+        .exclude(file_hash='')
+        .order_by('name', 'id')
+    )
+    if cursor:
+        queryset = pagination.seek(queryset, ['name', 'id'], cursor)
+    return queryset.values(*dict.fromkeys(['id', 'name', *fields]))
+
+
+def find_hashes(hashes, batch_size=500):
+    # one shared copy per hash, the IN lists stay under the sqlite variable limit
+    found = {}
+    # '' would match the files indexed without a hash
+    hashes = list(set(hashes) - {''})
+    for start in range(0, len(hashes), batch_size):
+        rows = (
+            File
+            .objects
+            .filter(file_hash__in=hashes[start:start + batch_size], hidden=False, storage__hidden=False)
+            .values('name', 'size', 'file_hash')
+        )
+        for row in rows:
+            found.setdefault(row['file_hash'], row)
+    return list(found.values())
+
+
+def find_rows(search_str, fields, cursor, count):
+    # the in-memory index when this process has one, the database otherwise
+    index = name_index.get_index()
+    if index is not None:
+        return index.search(search_str, fields, cursor, count)
+    return list(search_rows(search_str, fields, cursor)[:count])
+
+
+def project(row, fields):
+    return {field: row[field] for field in fields}
+
+
+def search_page(search_str, limit, fields, cursor=None):
+    rows = find_rows(search_str, fields, cursor, limit + 1)
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [project(row, fields) for row in rows[:limit]], next_cursor
+
+
+def search_lines(search_str, limit, fields, cursor=None):
+    # NDJSON: one file per line, the last line holds the cursor of the next page
+    next_cursor = None
+    last_row = None
+    for count, row in enumerate(find_rows(search_str, fields, cursor, limit + 1)):
+        if count == limit:
+            next_cursor = encode_cursor(last_row)
+            break
+        last_row = row
+        yield json.dumps(project(row, fields)) + '\n'
+    yield json.dumps({'next': next_cursor}) + '\n'
@@ -0,0 +1,133 @@
+import asyncio
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, Http404, StreamingHttpResponse
+
+from client.settings import FILE_SERVE_MODE, FILE_SERVE_ACCEL_PREFIX, FILE_SERVE_BLOCK_SIZE
+from client_app import metrics
+from client_app.throttle import aiter_throttled, iter_throttled, upload_bucket
+
+
+def get_etag(file, stat):
+    return f'"{file.file_hash}"' if file.matches_stat(stat) else None
+
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(request, etag, size):
+    # returns (start, end) of a single byte range, None to send the whole file, or False if unsatisfiable
+    match = _range_re.match(request.META.get('HTTP_RANGE', '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    # If-Range: the client's copy is outdated, it gets the whole file instead
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        return None
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def read_range(opened_file, start, length, block_size=FILE_SERVE_BLOCK_SIZE):
+    with opened_file:
+        opened_file.seek(start)
+        while length > 0:
+            block = opened_file.read(min(block_size, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+async def aread_range(opened_file, start, length, block_size=FILE_SERVE_BLOCK_SIZE):
+    # reads run in the default executor, the event loop only waits for them
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, opened_file.seek, start)
+        while length > 0:
+            block = await loop.run_in_executor(None, opened_file.read, min(block_size, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        opened_file.close()
+
+
+class AsyncStreamingResponse(StreamingHttpResponse):
+    # the body is an async iterator, only client.asgi.ClientASGIHandler knows how to send it
+    def __init__(self, chunks, *args, **kwargs):
+        super().__init__((), *args, **kwargs)
+        self.async_streaming_content = chunks
+
+
+def serve_file(request, file, as_attachment=False, use_async=False):
+    try:
+        opened_file = open(file.path, 'rb')
+    except OSError:
+        raise Http404('File is not available')
+    stat = os.fstat(opened_file.fileno())
+    etag = get_etag(file, stat)
+    if etag and etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        opened_file.close()
+        return HttpResponseNotModified()
+
+    mime_type = mimetypes.guess_type(file.path)[0] or 'application/octet-stream'
+    # the front proxy handles ranges itself
+    byte_range = None if FILE_SERVE_MODE else parse_range(request, etag, stat.st_size)
+    if FILE_SERVE_MODE:
+        # the front proxy sends the file itself
+        opened_file.close()
+        response = HttpResponse(content_type=mime_type)
+        if FILE_SERVE_MODE == 'x-accel':
+            # nginx decodes the uri, so spaces, '%', '?' and non-ascii names survive
+            response['X-Accel-Redirect'] = quote(FILE_SERVE_ACCEL_PREFIX + file.path)
+        else:
+            # a plain file system path: its raw bytes, which latin-1 passes through unchanged
+            response['X-Sendfile'] = os.fsencode(file.path).decode('latin-1')
+    elif byte_range is False:
+        opened_file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+    elif byte_range or upload_bucket.rate or use_async:
+        # ranges, limited uploads and everything under ASGI are sent by Django itself
+        start, end = byte_range or (0, stat.st_size - 1)
+        if use_async:
+            response = AsyncStreamingResponse(
+                aiter_throttled(aread_range(opened_file, start, end - start + 1), upload_bucket),
+                status=206 if byte_range else 200,
+                content_type=mime_type
+            )
+        else:
+            response = StreamingHttpResponse(
+                iter_throttled(read_range(opened_file, start, end - start + 1), upload_bucket),
+                status=206 if byte_range else 200,
+                content_type=mime_type
+            )
+        if byte_range:
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = str(end - start + 1)
+        response['Accept-Ranges'] = 'bytes'
+    else:
+        # wsgi.file_wrapper lets the server use sendfile, block_size only matters without it
+        response = FileResponse(opened_file, content_type=mime_type)
+        response.block_size = FILE_SERVE_BLOCK_SIZE
+        response['Content-Length'] = str(stat.st_size)
+        response['Accept-Ranges'] = 'bytes'
+    # counted when the response is handed over, a client may still drop the connection
+    metrics.transfer_bytes.inc(int(response.get('Content-Length', stat.st_size)), direction='upload')
+    if as_attachment:
+        response['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(file.name)}"
+    if etag:
+        response['ETag'] = etag
+    return response
@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import threading
+import time
+
+import httpx
+import requests
+
+from client.settings import (
+    CLIENT_PORT, PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT, SUMMARY_FALSE_POSITIVE_RATE, SUMMARY_MAX_BYTES,
+    SUMMARY_MISSING_REFRESH, SUMMARY_REFRESH
+)
+from client_app import async_http_client, http_client, metrics
+from client_app.bloom import BloomFilter
+from client_app.models import File, Storage
+from client_app.name_index import trigrams
+
+# the summary of this client: (version, summary)
+_summary = [None, None]
+_summary_lock = threading.Lock()
+# summaries of other clients: address -> PeerSummary
+_peers = {}
+# summaries loaded in the background on the event loop
+_loading = set()
+
+
+class PeerSummary:
+    def __init__(self, version=None, bloom=None):
+        self.version = version
+        # None when the peer has no summary, it is always asked then
+        self.bloom = bloom
+        self.checked = time.monotonic()
+
+    def is_fresh(self, since=None):
+        # current when checked since the search started. Knowing there is no summary rules nothing out,
+        # it can be kept longer without missing files
+        age = time.monotonic() - self.checked
+        if self.bloom is None:
+            return age < SUMMARY_MISSING_REFRESH
+        return since is not None and self.checked >= since or age < SUMMARY_REFRESH
+
+    def might_have(self, items):
+        return self.bloom is None or all(item in self.bloom for item in items)
+
+
+def name_items(search_str):
+    # empty for searches shorter than a trigram, those cannot be ruled out
+    return ['t:' + gram for gram in trigrams(search_str.lower())]
+
+
+def hash_items(file_hash):
+    return ['h:' + file_hash]
+
+
+def shared_files():
+    # the files search_rows and find_hashes answer with
+    return File.objects.filter(hidden=False, storage__hidden=False).exclude(file_hash='')
+
+
+def get_version():
+    # moves whenever a storage is hidden, shown, removed or its files change, see name_index.touch
+    storages = list(Storage.objects.order_by('id').values_list('id', 'hidden', 'files_version'))
+    return hashlib.sha256(repr(storages).encode()).hexdigest()[:16]
+
+
+def build_summary(version, false_positive_rate=SUMMARY_FALSE_POSITIVE_RATE, max_bytes=SUMMARY_MAX_BYTES):
+    grams = set()
+    for name in shared_files().values_list('name', flat=True).distinct().iterator():
+        grams.update(trigrams(name.lower()))
+    hashes = list(shared_files().values_list('file_hash', flat=True).distinct())
+    bloom = BloomFilter.for_items(len(grams) + len(hashes), false_positive_rate, max_bytes)
+    for gram in grams:
+        bloom.add('t:' + gram)
+    for file_hash in hashes:
+        bloom.add('h:' + file_hash)
+    return {
+        'version': version,
+        'items': len(grams) + len(hashes),
+        'false_positive_rate': round(bloom.false_positive_rate(), 6),
+        **bloom.to_dict(),
+    }
+
+
+def get_summary(version):
+    # built once per version, concurrent requests wait for the same build
+    with _summary_lock:
+        if _summary[0] != version:
+            _summary[:] = version, build_summary(version)
+        return _summary[1]
+
+
+def parse_summary(data):
+    return PeerSummary(data['version'], BloomFilter.from_dict(data))
+
+
+def store_answer(address, status_code, load_json):
+    known = _peers.get(address)
+    if status_code == 304 and known is not None:
+        known.checked = time.monotonic()
+        return
+    try:
+        if status_code != 200:
+            raise ValueError(f'No summary: {status_code}')
+        _peers[address] = parse_summary(load_json())
+    except (ValueError, KeyError, TypeError):
+        # clients without /summary are asked every time, until the next check
+        _peers[address] = PeerSummary()
+
+
+def refresh_peer(address):
+    known = _peers.get(address)
+    try:
+        with metrics.time_peer(address, 'summary'):
+            response = http_client.get(
+                f'http://{address}:{CLIENT_PORT}/summary',
+                params={'version': known.version} if known and known.version else None,
+                timeout=(PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT)
+            )
+    except requests.exceptions.RequestException:
+        metrics.peer_errors.inc(operation='summary')
+        return
+    store_answer(address, response.status_code, response.json)
+
+
+async def refresh_peer_async(address):
+    known = _peers.get(address)
+    try:
+        with metrics.time_peer(address, 'summary'):
+            response = await async_http_client.get_client().get(
+                f'http://{address}:{CLIENT_PORT}/summary',
+                params={'version': known.version} if known and known.version else None,
+                timeout=httpx.Timeout(PEER_READ_TIMEOUT, connect=PEER_CONNECT_TIMEOUT)
+            )
+    except httpx.HTTPError:
+        metrics.peer_errors.inc(operation='summary')
+        return
+    store_answer(address, response.status_code, response.json)
+
+
+def get_known(address):
+    return _peers.get(address)
+
+
+def get_fresh(address, since=None):
+    known = _peers.get(address)
+    return known if known is not None and known.is_fresh(since) else None
+
+
+def needs_load(address):
+    # never asked, or a client without /summary asked long ago
+    known = _peers.get(address)
+    return known is None or known.bloom is None and not known.is_fresh()
+
+
+def plan(addresses, items):
+    # splits the peers without waiting for the network: (ask now, ask after a version check, summaries to load).
+    # Only an outdated summary that rules the items out is checked before its peer is asked, the searches of
+    # all other peers do not wait for it. Summaries of new peers are loaded for the next searches
+    ask, check = [], []
+    for address in addresses:
+        known = _peers.get(address)
+        if known is None or known.might_have(items):
+            ask.append(address)
+        elif not known.is_fresh():
+            check.append(address)
+    metrics.peer_searches_skipped.inc(len(addresses) - len(ask) - len(check))
+    return ask, check, [address for address in addresses if needs_load(address)]
+
+
+def might_have(address, items, since):
+    # a summary not checked since then rules nothing out
+    known = get_fresh(address, since)
+    if known is None or known.might_have(items):
+        return True
+    metrics.peer_searches_skipped.inc()
+    return False
+
+
+def check_peer(address, items):
+    # True when the summary, checked just now, cannot rule the items out
+    since = time.monotonic()
+    refresh_peer(address)
+    return might_have(address, items, since)
+
+
+async def check_peer_async(address, items):
+    since = time.monotonic()
+    await refresh_peer_async(address)
+    return might_have(address, items, since)
+
+
+def load_async(addresses):
+    # the event loop keeps only weak references to tasks, nobody else waits for these
+    for address in addresses:
+        task = asyncio.ensure_future(refresh_peer_async(address))
+        _loading.add(task)
+        task.add_done_callback(_loading.discard)
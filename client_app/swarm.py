@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from client.settings import (
+    CLIENT_PORT, DOWNLOAD_CHUNK_SIZE, PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT, SWARM_PIECE_SIZE, SWARM_WORKERS,
+    SWARM_PIECE_TIMEOUT, SWARM_MAX_PEER_FAILURES, SWARM_PIECES_POLL, SWARM_PIECES_WAIT
+)
+from client_app import downloads, http_client
+from client_app.hashing import hash_file, hash_pieces
+from client_app.helper import get_setting
+from client_app.models import File, PieceHashes
+from client_app.peers import HashLookup, PeerSearch, ServerError, get_online_clients
+from client_app.throttle import download_bucket, iter_throttled
+
+logger = logging.getLogger(__name__)
+
+
+class PieceError(Exception):
+    pass
+
+
+def get_piece_hashes(file_hash, piece_size=SWARM_PIECE_SIZE):
+    # None until store_piece_hashes has run for the file
+    stored = PieceHashes.objects.filter(file_hash=file_hash, piece_size=piece_size).first()
+    if stored is None:
+        return None
+    return [stored.pieces[start:start + 64] for start in range(0, len(stored.pieces), 64)]
+
+
+def store_piece_hashes(file_hash, piece_size=SWARM_PIECE_SIZE):
+    # pieces depend only on the content, so they are stored by file_hash and reused for every copy.
+    # A copy changed or removed since the last scan is skipped, its content no longer matches file_hash
+    if PieceHashes.objects.filter(file_hash=file_hash, piece_size=piece_size).exists():
+        return True
+    for file in File.objects.filter(file_hash=file_hash, hidden=False, storage__hidden=False).order_by('id'):
+        if file.get_unchanged_stat() is None:
+            continue
+        try:
+            pieces = ''.join(hash_pieces(file.path, piece_size))
+        except OSError:
+            continue
+        if file.get_unchanged_stat() is None:
+            continue
+        PieceHashes.objects.get_or_create(file_hash=file_hash, piece_size=piece_size, defaults={'pieces': pieces})
+        return True
+    return False
+
+
+def find_sources(ip, name, file_hash):
+    # {address: file name} of every online client sharing the file under any name
+    sources = {ip: name}
+    server = get_setting('server')
+    token = get_setting('token')
+    if not server or not token:
+        return sources
+    try:
+        available = get_online_clients(server, token)
+    except ServerError:
+        return sources
+    addresses = [client['address'] for client in available if client['user'] != get_setting('login')]
+    lookup = HashLookup(addresses, [file_hash])
+    for file in lookup.run().get(file_hash, []):
+        sources.setdefault(file['url'], file['name'])
+    # older clients only find it by name
+    for address, files in PeerSearch(lookup.unsupported, name):
+        for file in files:
+            if file['file_hash'] == file_hash:
+                sources.setdefault(address, file['name'])
+    return sources
+
+
+def parse_piece_list(data, piece_size):
+    size, pieces = data['size'], data['pieces']
+    if not isinstance(size, int) or not isinstance(pieces, list) or len(pieces) != -(-size // piece_size):
+        raise ValueError('Wrong piece list')
+    if not all(isinstance(piece, str) and len(piece) == 64 for piece in pieces):
+        raise ValueError('Wrong piece hash')
+    return size, pieces
+
+
+def fetch_piece_list(peers, file_hash, piece_size, wait=SWARM_PIECES_WAIT):
+    # peers answering 202 are still hashing, they are asked again until wait runs out
+    waiting = list(peers)
+    deadline = time.monotonic() + wait
+    while True:
+        asked, waiting = waiting, []
+        for peer in asked:
+            try:
+                response = http_client.get(
+                    f'http://{peer}:{CLIENT_PORT}/pieces',
+                    params={'file_hash': file_hash, 'piece_size': piece_size},
+                    timeout=(PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT)
+                )
+                if response.status_code == 202:
+                    waiting.append(peer)
+                elif response.status_code == 200:
+                    return parse_piece_list(response.json(), piece_size)
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+                # one broken answer only rules out this peer
+                logger.info('No piece list from %s: %s', peer, e)
+        if not waiting or time.monotonic() + SWARM_PIECES_POLL > deadline:
+            break
+        time.sleep(SWARM_PIECES_POLL)
+    return None, None
+
+
+class Swarm:
+    def __init__(self, sources, file_hash, size, pieces, piece_size, path, progress):
+        self.sources = sources
+        self.progress = progress
+        self.file_hash = file_hash
+        self.size = size
+        self.pieces = pieces
+        self.piece_size = piece_size
+        self.path = path
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.in_flight = 0
+        self.active = {peer: 0 for peer in sources}
+        self.failures = {peer: 0 for peer in sources}
+
+    def piece_range(self, index):
+        start = index * self.piece_size
+        return start, min(start + self.piece_size, self.size) - 1
+
+    def check_existing(self):
+        # pieces already written by an earlier attempt do not need to be loaded again
+        with open(self.path, 'rb') as f:
+            for index, piece_hash in enumerate(self.pieces):
+                start, end = self.piece_range(index)
+                f.seek(start)
+                if hashlib.sha256(f.read(end - start + 1)).hexdigest() != piece_hash:
+                    self.pending.append(index)
+
+    def take(self):
+        with self.condition:
+            while not self.pending:
+                if not self.in_flight:
+                    return None, None
+                self.condition.wait()
+            alive = [peer for peer in self.active if self.failures[peer] < SWARM_MAX_PEER_FAILURES]
+            if not alive:
+                return None, None
+            # least busy peer first
+            peer = min(alive, key=lambda address: self.active[address])
+            self.active[peer] += 1
+            self.in_flight += 1
+            return self.pending.popleft(), peer
+
+    def release(self, index, peer, failed):
+        with self.condition:
+            self.active[peer] -= 1
+            self.in_flight -= 1
+            if failed:
+                self.failures[peer] += 1
+                self.pending.append(index)
+            else:
+                start, end = self.piece_range(index)
+                self.progress.add(end - start + 1)
+            self.condition.notify_all()
+
+    def fetch_piece(self, index, peer):
+        start, end = self.piece_range(index)
+        finish_by = time.monotonic() + SWARM_PIECE_TIMEOUT
+        data = bytearray()
+        with http_client.get(
+            f'http://{peer}:{CLIENT_PORT}/getfile',
+            params={'name': self.sources[peer], 'file_hash': self.file_hash},
+            headers={'Range': f'bytes={start}-{end}'},
+            timeout=(PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT),
+            stream=True
+        ) as response:
+            if response.status_code != 206:
+                raise PieceError(f'{peer} answered {response.status_code}')
+            for chunk in iter_throttled(response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE), download_bucket):
+                data += chunk
+                # a slow peer gives the piece back to somebody faster
+                if time.monotonic() > finish_by:
+                    raise PieceError(f'{peer} is too slow')
+        if hashlib.sha256(data).hexdigest() != self.pieces[index]:
+            raise PieceError(f'{peer} sent a broken piece {index}')
+        return start, data
+
+    def worker(self):
+        with open(self.path, 'r+b') as f:
+            while True:
+                index, peer = self.take()
+                if index is None:
+                    return
+                failed = True
+                try:
+                    start, data = self.fetch_piece(index, peer)
+                    f.seek(start)
+                    f.write(data)
+                    failed = False
+                except (requests.exceptions.RequestException, PieceError) as e:
+                    logger.info('Piece %s of %s failed: %s', index, self.file_hash, e)
+                finally:
+                    self.release(index, peer, failed)
+
+    def run(self):
+        resumed = os.path.exists(self.path)
+        with open(self.path, 'ab') as f:
+            # preallocate, so pieces can be written in any order
+            f.truncate(self.size)
+        # only a file left by an earlier attempt is worth hashing, a new one is all holes
+        if resumed:
+            self.check_existing()
+        else:
+            self.pending.extend(range(len(self.pieces)))
+        missing = sum(end - start + 1 for start, end in map(self.piece_range, self.pending))
+        self.progress.start(self.size, self.size - missing)
+        with ThreadPoolExecutor(max_workers=SWARM_WORKERS) as executor:
+            for future in [executor.submit(self.worker) for _ in range(SWARM_WORKERS)]:
+                future.result()
+        if self.pending:
+            raise downloads.DownloadError('No client could send the rest of the file, load it again to resume')
+
+
+def load_file(ip, name, file_hash, progress=None, select_sources=None):
+    # loads from every client having the file, or only from ip when it is the single source.
+    # select_sources leaves out the clients other downloads already use
+    downloads.check_file_hash(file_hash)
+    sources = find_sources(ip, name, file_hash)
+    if select_sources is not None and len(sources) > 1:
+        sources = {address: sources[address] for address in select_sources(list(sources))}
+    size, pieces = fetch_piece_list(sources, file_hash, SWARM_PIECE_SIZE) if len(sources) > 1 else (None, None)
+    if pieces is None:
+        return downloads.download_file(ip, name, file_hash, progress=progress)
+
+    path = downloads.get_media_path(name)
+    swarm_path = downloads.get_part_path(file_hash) + '.swarm'
+    os.makedirs(os.path.dirname(swarm_path), exist_ok=True)
+    progress = progress or downloads.TransferProgress()
+    Swarm(sources, file_hash, size, pieces, SWARM_PIECE_SIZE, swarm_path, progress).run()
+    if hash_file(swarm_path) != file_hash:
+        os.remove(swarm_path)
+        raise downloads.DownloadError('Downloaded file does not match its hash')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path = downloads.get_free_path(path)
+    os.replace(swarm_path, path)
+    return path
@@ -1,25 +1,206 @@
-import requests
+import logging
+import threading
+from collections import Counter
+from datetime import timedelta
+from functools import partial
+
 from background_task import background
 from background_task.models import Task
+from django.db import connection, transaction
+from django.utils import timezone
+
+from client.settings import (
+    DOWNLOAD_HEARTBEAT, DOWNLOAD_MAX_ACTIVE, DOWNLOAD_MAX_PER_PEER, DOWNLOAD_RETRY_DELAY, DOWNLOAD_STALE_AFTER
+)
+from client_app import downloads, swarm
+from client_app.models import Lock, Storage, StorageScan, Transfer
+from client_app.scanner import ScanProgress, get_nested_storage_paths, get_parent_storages, scan_storage
+
+logger = logging.getLogger(__name__)
+
+
+@background(schedule=0, queue='scan')
+def scan_storage_task(storage_id):
+    storage = Storage.objects.filter(id=storage_id).first()
+    # storage was deleted while the scan was queued
+    if storage is None:
+        return
+    scan, _ = StorageScan.objects.get_or_create(storage=storage)
+    scan.status = StorageScan.RUNNING
+    scan.files_seen = scan.files_to_hash = scan.files_hashed = 0
+    scan.bytes_to_hash = scan.bytes_hashed = 0
+    scan.started = timezone.now()
+    scan.finished = None
+    scan.save()
+    try:
+        scan_storage(storage, get_nested_storage_paths(storage, Storage.objects.all()), ScanProgress(scan))
+    except Exception:
+        scan.status = StorageScan.FAILED
+        scan.save()
+        raise
+    scan.status = StorageScan.DONE
+    scan.finished = timezone.now()
+    scan.save()
+
+
+def get_scan_task_name(storage_id):
+    return f'scan storage {storage_id}'
+
+
+def is_scan_pending(storage):
+    # queued or running, a task whose worker died is run again once its lock expires
+    return Task.objects.filter(verbose_name=get_scan_task_name(storage.id)).exists()
+
+
+def queue_storage_scan(storage):
+    verbose_name = get_scan_task_name(storage.id)
+    # one pending scan per storage is enough, a running one does not count. Callers wait for each other
+    # on the StorageScan row, otherwise both could see no pending task and queue one each
+    with transaction.atomic():
+        scan, _ = StorageScan.objects.select_for_update().get_or_create(storage=storage)
+        if Task.objects.filter(verbose_name=verbose_name, locked_by=None).exists():
+            return
+        if scan.status != StorageScan.RUNNING:
+            scan.status = StorageScan.QUEUED
+            scan.save()
+        scan_storage_task(storage.id, verbose_name=verbose_name)
+
+
+def queue_parent_scans(storage):
+    # files of a storage added inside another one have to leave the parent, files of a removed one come back
+    for parent in get_parent_storages(storage, Storage.objects.all()):
+        queue_storage_scan(parent)
+
+
+@background(schedule=0, queue='scan')
+def piece_hashes_task(file_hash):
+    if not swarm.store_piece_hashes(file_hash):
+        logger.info('No unchanged copy of %s to hash the pieces of', file_hash)
+
+
+def queue_piece_hashes(file_hash):
+    verbose_name = f'piece hashes {file_hash}'
+    # clients keep asking until the pieces are there, one task per file is enough
+    if Task.objects.filter(verbose_name=verbose_name).exists():
+        return
+    piece_hashes_task(file_hash, verbose_name=verbose_name)
+
+
+def reset_stale_transfers():
+    # downloads whose worker crashed or was killed, they would count against the limits forever
+    Transfer.objects.filter(
+        status=Transfer.RUNNING,
+        updated__lt=timezone.now() - timedelta(seconds=DOWNLOAD_STALE_AFTER)
+    ).update(status=Transfer.FAILED, error='Download stopped, load the file again to resume', updated=timezone.now())
+
+
+def lock_downloads():
+    # queueing and claiming of downloads wait for each other on one Lock row, inside their transaction.
+    # Locking the running transfers would lock nothing while none is running
+    Lock.objects.select_for_update().get_or_create(name='downloads')
+
+
+def get_busy_peers(exclude_id=None):
+    # running downloads per client, a swarm download counts for every client it loads from
+    busy = Counter()
+    running = Transfer.objects.filter(status=Transfer.RUNNING).exclude(id=exclude_id)
+    for ip, sources in running.values_list('ip', 'sources'):
+        busy.update({ip, *sources.split()})
+    return busy
+
+
+def claim_transfer(transfer):
+    # respects the global and the per-client limits of running downloads. A file is loaded by one download at
+    # a time, the part file is named by its hash. None if the transfer is not queued anymore
+    with transaction.atomic():
+        lock_downloads()
+        reset_stale_transfers()
+        running = Transfer.objects.filter(status=Transfer.RUNNING).exclude(id=transfer.id)
+        if (
+            running.count() >= DOWNLOAD_MAX_ACTIVE
+            or get_busy_peers(exclude_id=transfer.id)[transfer.ip] >= DOWNLOAD_MAX_PER_PEER
+            or running.filter(file_hash=transfer.file_hash).exists()
+        ):
+            return False
+        claimed = Transfer.objects.filter(id=transfer.id, status=Transfer.QUEUED).update(
+            status=Transfer.RUNNING, sources=transfer.ip, error='', updated=timezone.now()
+        )
+    if not claimed:
+        return None
+    transfer.status = Transfer.RUNNING
+    transfer.sources = transfer.ip
+    transfer.error = ''
+    return True
+
+
+def claim_sources(transfer, addresses):
+    # a swarm download loads from more clients than the one it was claimed for, the others are used only
+    # while they are below DOWNLOAD_MAX_PER_PEER
+    with transaction.atomic():
+        lock_downloads()
+        busy = get_busy_peers(exclude_id=transfer.id)
+        chosen = [transfer.ip] + [
+            address for address in addresses if address != transfer.ip and busy[address] < DOWNLOAD_MAX_PER_PEER
+        ]
+        Transfer.objects.filter(id=transfer.id).update(sources=' '.join(chosen))
+    transfer.sources = ' '.join(chosen)
+    return chosen
 
-from client.settings import SERVER_PORT
-from client_app.helper import get_setting, save_setting
 
-_seconds_between_checks = 5
+def keep_alive(transfer_id, stop):
+    # marks the download as alive while it runs, also when no bytes arrive for a while
+    try:
+        while not stop.wait(DOWNLOAD_HEARTBEAT):
+            Transfer.objects.filter(id=transfer_id, status=Transfer.RUNNING).update(updated=timezone.now())
+    finally:
+        connection.close()
 
 
-@background(schedule=_seconds_between_checks)
-def ping_server():
-    server = get_setting('server')
-    token = get_setting('token')
-    if server and token:
-        response = requests.get(f'http://{server}:{SERVER_PORT}/ping', headers={'Authorization': f'TOKEN {token}'})
-        if response.status_code == 200:
-            save_setting('is_online', '1')
+@background(schedule=0, queue='download')
+def download_task(transfer_id):
+    transfer = Transfer.objects.filter(id=transfer_id, status=Transfer.QUEUED).first()
+    if transfer is None:
+        return
+    claimed = claim_transfer(transfer)
+    if claimed is None:
+        return
+    if not claimed:
+        download_task(transfer_id, schedule=DOWNLOAD_RETRY_DELAY, verbose_name=f'download {transfer_id}')
+        return
+    stop = threading.Event()
+    threading.Thread(target=keep_alive, args=(transfer_id, stop), daemon=True).start()
+    try:
+        path = swarm.load_file(
+            transfer.ip, transfer.name, transfer.file_hash, progress=downloads.TransferProgress(transfer),
+            select_sources=partial(claim_sources, transfer)
+        )
+        downloads.register_media_file(path, transfer.file_hash)
+    except Exception as e:
+        # the transfer can be started again from the downloads page, it resumes from the .part file
+        if not isinstance(e, downloads.DownloadError):
+            logger.exception('Download of %s failed', transfer.file_hash)
+        transfer.status = Transfer.FAILED
+        transfer.error = str(e)[:255]
     else:
-        save_setting('is_online', '0')
+        transfer.status = Transfer.DONE
+    finally:
+        stop.set()
+    transfer.save()
 
 
-def start_ping():
-    Task.objects.filter(verbose_name='ping').delete()
-    ping_server(repeat=_seconds_between_checks, verbose_name='ping')
+def queue_download(transfer):
+    # a file already queued or loading is not loaded twice, returns the transfer that loads it
+    with transaction.atomic():
+        lock_downloads()
+        active = (
+            Transfer.objects
+            .filter(file_hash=transfer.file_hash, status__in=(Transfer.QUEUED, Transfer.RUNNING))
+            .exclude(id=transfer.id)
+            .first()
+        )
+        if active is not None:
+            return active
+        transfer.status = Transfer.QUEUED
+        transfer.save()
+        download_task(transfer.id, verbose_name=f'download {transfer.id}')
+    return transfer
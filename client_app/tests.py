@@ -1,3 +1,797 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import unquote
+
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import escape
+
+from client.settings import DOWNLOAD_MAX_ACTIVE, DOWNLOAD_STALE_AFTER, HASH_LOOKUP_MAX, SWARM_MAX_PEER_FAILURES
+from client_app import downloads, hash_cache, metrics, name_index, peers, serving, summary, swarm, tasks
+from client_app.bloom import BloomFilter
+from client_app.helper import get_setting, invalidate_settings, save_setting, save_settings
+from client_app.indexer import index_storage
+from client_app.models import File, HashCache, Settings, Storage, Transfer
+from client_app.scanner import scan_storage
+from client_app.search import find_hashes, search_rows
+from client_app.watcher import StorageWatcher
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def sha(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class ScanStorageTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.storage = Storage.objects.create(path=self.root)
+
+    def files(self):
+        return {file.name: file.file_hash for file in File.objects.filter(storage=self.storage)}
+
+    def test_added_updated_deleted(self):
+        write_file(os.path.join(self.root, 'a.txt'), b'a')
+        write_file(os.path.join(self.root, 'dir', 'b.txt'), b'b')
+        result = scan_storage(self.storage)
+        self.assertEqual((result.added, result.updated, result.deleted), (2, 0, 0))
+        self.assertEqual(self.files(), {'a.txt': sha(b'a'), 'b.txt': sha(b'b')})
+
+        write_file(os.path.join(self.root, 'a.txt'), b'changed')
+        os.utime(os.path.join(self.root, 'a.txt'), ns=(1, 1))
+        os.remove(os.path.join(self.root, 'dir', 'b.txt'))
+        write_file(os.path.join(self.root, 'c.txt'), b'c')
+        result = scan_storage(self.storage)
+        self.assertEqual((result.added, result.updated, result.deleted), (1, 1, 1))
+        self.assertEqual(self.files(), {'a.txt': sha(b'changed'), 'c.txt': sha(b'c')})
+        self.storage.refresh_from_db()
+        self.assertEqual(self.storage.files_count, 2)
+
+    def test_unchanged_files_are_not_written(self):
+        write_file(os.path.join(self.root, 'a.txt'), b'a')
+        scan_storage(self.storage)
+        result = scan_storage(self.storage)
+        self.assertEqual((result.added, result.updated, result.deleted, result.unchanged), (0, 0, 0, 1))
+
+    def test_nested_storage_is_skipped(self):
+        write_file(os.path.join(self.root, 'a.txt'), b'a')
+        write_file(os.path.join(self.root, 'nested', 'b.txt'), b'b')
+        scan_storage(self.storage, {os.path.join(self.root, 'nested')})
+        self.assertEqual(set(self.files()), {'a.txt'})
+
+    def test_missing_storage_keeps_files(self):
+        write_file(os.path.join(self.root, 'a.txt'), b'a')
+        scan_storage(self.storage)
+        shutil.rmtree(self.root)
+        scan_storage(self.storage)
+        self.assertEqual(set(self.files()), {'a.txt'})
+
+    def test_index_resume_deletes_removed_files(self):
+        write_file(os.path.join(self.root, 'a.txt'), b'a')
+        write_file(os.path.join(self.root, 'b.txt'), b'b')
+        index_storage(self.storage)
+        os.remove(os.path.join(self.root, 'b.txt'))
+        write_file(os.path.join(self.root, 'c.txt'), b'c')
+        result = index_storage(self.storage, resume=True)
+        self.assertEqual((result.skipped, result.written, result.deleted), (1, 1, 1))
+        self.assertEqual(self.files(), {'a.txt': sha(b'a'), 'c.txt': sha(b'c')})
+
+    def test_files_without_hash_are_not_shared(self):
+        write_file(os.path.join(self.root, 'a.txt'), b'a')
+        index_storage(self.storage, with_hash=False)
+        self.assertEqual(self.files(), {'a.txt': ''})
+        index = name_index.NameIndex()
+        index.sync()
+        self.assertEqual(list(search_rows('a', ['name'])), [])
+        self.assertEqual(index.search('a', ['name']), [])
+        self.assertEqual(find_hashes(['']), [])
+        # the next scan adds the hash and shares the file
+        scan_storage(self.storage)
+        index.sync()
+        self.assertEqual([row['name'] for row in search_rows('a', ['name'])], ['a.txt'])
+        self.assertEqual([row['name'] for row in index.search('a', ['name'])], ['a.txt'])
+
+
+class HashCacheTest(TestCase):
+    def setUp(self):
+        hash_cache._evictions = 0
+        now = timezone.now()
+        for inode in range(10):
+            HashCache.objects.create(inode=inode, device=1, size=1, mtime=1, file_hash=sha(bytes([inode])))
+            HashCache.objects.filter(inode=inode).update(last_seen=now - timedelta(days=10 - inode, hours=-12))
+
+    def inodes(self):
+        return sorted(HashCache.objects.values_list('inode', flat=True))
+
+    def test_evict_by_age(self):
+        self.assertEqual(hash_cache.evict(max_age=5, max_entries=100), 5)
+        self.assertEqual(self.inodes(), [5, 6, 7, 8, 9])
+
+    def test_evict_least_recently_seen(self):
+        key = hash_cache.CacheKey(0, 1, 1, 1)
+        self.assertEqual(hash_cache.lookup([key]), {key: sha(bytes([0]))})
+        self.assertEqual(hash_cache.evict(max_age=100, max_entries=4), 6)
+        self.assertEqual(self.inodes(), [0, 7, 8, 9])
+
+    def test_lookup_metrics(self):
+        hits, misses = metrics.cache_hits.values.get(('hash',), 0), metrics.cache_misses.values.get(('hash',), 0)
+        hash_cache.lookup([hash_cache.CacheKey(1, 1, 1, 1), hash_cache.CacheKey(1, 1, 1, 2)])
+        self.assertEqual(metrics.cache_hits.values[('hash',)], hits + 1)
+        self.assertEqual(metrics.cache_misses.values[('hash',)], misses + 1)
+        self.assertIn(f'client_cache_hits_total{{cache="hash"}} {hits + 1}', metrics.render())
+
+    def test_count_every(self):
+        self.assertEqual(hash_cache.evict(max_age=100, max_entries=8, count_every=3), 2)
+        HashCache.objects.create(inode=100, device=1, size=1, mtime=1, file_hash=sha(b'new'))
+        with self.assertNumQueries(1):
+            self.assertEqual(hash_cache.evict(max_age=100, max_entries=8, count_every=3), 0)
+        hash_cache.evict(max_age=100, max_entries=8, count_every=3)
+        self.assertEqual(hash_cache.evict(max_age=100, max_entries=8, count_every=3), 1)
+        self.assertEqual(len(self.inodes()), 8)
+
+
+class GetFileRangeTest(TestCase):
+    content = b'0123456789'
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        write_file(os.path.join(root, 'file.bin'), self.content)
+        scan_storage(Storage.objects.create(path=root))
+        self.file = File.objects.get()
+
+    def get(self, **headers):
+        params = {'name': self.file.name, 'file_hash': self.file.file_hash}
+        return self.client.get(reverse('getfile'), params, **headers)
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f'"{self.file.file_hash}"')
+        self.assertEqual(self.body(response), self.content)
+
+    def test_ranges(self):
+        for header, content_range, body in (
+            ('bytes=2-4', 'bytes 2-4/10', b'234'),
+            ('bytes=7-', 'bytes 7-9/10', b'789'),
+            ('bytes=-3', 'bytes 7-9/10', b'789'),
+            ('bytes=8-100', 'bytes 8-9/10', b'89'),
+        ):
+            with self.subTest(header):
+                response = self.get(HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response['Content-Range'], content_range)
+                self.assertEqual(response['Content-Length'], str(len(body)))
+                self.assertEqual(self.body(response), body)
+
+    def test_unsatisfiable_range(self):
+        for header in ('bytes=10-', 'bytes=5-2'):
+            with self.subTest(header):
+                response = self.get(HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_if_range(self):
+        response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE=f'"{self.file.file_hash}"')
+        self.assertEqual(response.status_code, 206)
+        # the client's copy is outdated, it gets the whole file
+        response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+
+    def test_not_modified(self):
+        response = self.get(HTTP_IF_NONE_MATCH=f'"{self.file.file_hash}"')
+        self.assertEqual(response.status_code, 304)
+
+    def rename(self, name):
+        path = os.path.join(os.path.dirname(self.file.path), name)
+        os.rename(self.file.path, path)
+        File.objects.filter(id=self.file.id).update(name=name, path=path)
+        self.file.refresh_from_db()
+
+    def test_x_accel(self):
+        self.rename('файл #1 50%?.bin')
+        with mock.patch.object(serving, 'FILE_SERVE_MODE', 'x-accel'):
+            response = self.get(HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        redirect = response['X-Accel-Redirect']
+        self.assertTrue(redirect.isascii())
+        self.assertNotIn('#', redirect)
+        self.assertEqual(unquote(redirect), '/protected' + self.file.path)
+
+    def test_x_sendfile(self):
+        self.rename('файл 1.bin')
+        with mock.patch.object(serving, 'FILE_SERVE_MODE', 'x-sendfile'):
+            response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'X-Sendfile: ' + os.fsencode(self.file.path) + b'\r\n', response.serialize_headers() + b'\r\n')
+
+
+def json_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+class SearchCursorTest(TestCase):
+    names = ['movie 1.mkv', 'Movie 2.mkv', 'movie 3.mkv', 'notes.txt', 'movie 4.mkv', 'movie 1.mkv']
+
+    def setUp(self):
+        storage = Storage.objects.create(path='/storage')
+        for name in self.names:
+            File.objects.create(name=name, path=f'/storage/{name}', file_hash=sha(name.encode()), storage=storage)
+        File.objects.create(name='movie hidden.mkv', path='/storage/hidden', file_hash='', storage=storage, hidden=True)
+        self.addCleanup(name_index.set_index, None)
+
+    def use_index(self):
+        index = name_index.NameIndex()
+        index.sync()
+        name_index.set_index(index)
+
+    def search(self, **params):
+        return self.client.get(reverse('search_file'), {'search_str': 'movie', **params})
+
+    def walk(self, limit):
+        names = []
+        params = {'limit': limit}
+        while True:
+            response = self.search(**params)
+            self.assertEqual(response.status_code, 200)
+            names.extend(file['name'] for file in response.json()['files'])
+            if response.json()['next'] is None:
+                return names
+            params['cursor'] = response.json()['next']
+
+    def test_pages_follow_each_other(self):
+        expected = sorted(name for name in self.names if 'movie' in name.lower())
+        for mode in ('database', 'index'):
+            with self.subTest(mode):
+                if mode == 'index':
+                    self.use_index()
+                for limit in (1, 2, 100):
+                    self.assertEqual(self.walk(limit), expected)
+
+    def test_wrong_cursor(self):
+        cursors = [
+            'not a cursor', json_cursor({}), json_cursor(['movie']), json_cursor([1, 'movie']),
+            json_cursor(['movie', '1']), json_cursor(['movie', True]), json_cursor(['movie', 1, 2]),
+        ]
+        for mode in ('database', 'index'):
+            if mode == 'index':
+                self.use_index()
+            for cursor in cursors:
+                with self.subTest(mode=mode, cursor=cursor):
+                    self.assertEqual(self.search(cursor=cursor).status_code, 400)
+                    self.assertEqual(self.search(cursor=cursor, stream='1').status_code, 400)
+
+    def test_wrong_limit_and_fields(self):
+        for params in ({'limit': 'x'}, {'limit': '0'}, {'fields': 'path'}):
+            with self.subTest(params):
+                self.assertEqual(self.search(**params).status_code, 400)
+        response = self.search(fields='name', limit='1000000')
+        self.assertEqual(len(response.json()['files']), 5)
+        self.assertEqual(set(response.json()['files'][0]), {'name'})
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('user', password='password'))
+        storage = Storage.objects.create(path='/storage')
+        # equal names are told apart by id
+        for number in range(23):
+            name = f'file {number % 7}.txt' if number % 2 else f'other {number}.txt'
+            File.objects.create(name=name, path=f'/storage/{number}', file_hash='', size=number, storage=storage)
+        for number in range(12):
+            Transfer.objects.create(ip='127.0.0.1', name=f'transfer {number}', file_hash='', status=Transfer.DONE)
+
+    def walk(self, url, query, link):
+        # object lists of the pages reached by following the link of every page
+        pages = []
+        while query is not None:
+            response = self.client.get(f'{url}?{query}')
+            self.assertEqual(response.status_code, 200)
+            pages.append(list(response.context['object_list']))
+            query = response.context.get(link)
+        return pages
+
+    def check(self, url, expected, search=''):
+        first = 'search=' + search if search else ''
+        forward = self.walk(url, first, 'next_query')
+        self.assertTrue(all(len(page) == 10 for page in forward[:-1]))
+        self.assertEqual(sum(forward, []), expected)
+        backward = self.walk(url, f'{first}&last=1' if first else 'last=1', 'previous_query')
+        # the last page is full, the first one holds what is left
+        self.assertTrue(all(len(page) == 10 for page in backward[:-1]))
+        self.assertEqual(sum(reversed(backward), []), expected)
+
+    def test_local_files(self):
+        self.check(reverse('local_files'), list(File.objects.order_by('name', 'id')))
+        files = File.objects.filter(name__icontains='file').order_by('name', 'id')
+        self.check(reverse('local_files'), list(files), 'file')
+
+    def test_storages_and_transfers(self):
+        self.check(reverse('transfers'), list(Transfer.objects.order_by('-created', '-id')))
+        self.check(reverse('storage'), list(Storage.objects.order_by('date', 'id')))
+
+    def test_links_keep_the_search(self):
+        response = self.client.get(reverse('local_files'), {'search': 'file'})
+        self.assertIn('search=file', response.context['next_query'])
+        self.assertIn('search=file', response.context['last_query'])
+        self.assertNotIn('previous_query', response.context)
+        self.assertContains(response, f'href="?{escape(response.context["next_query"])}"')
+
+    def test_wrong_cursor(self):
+        for query in ({'after': 'broken'}, {'before': json_cursor(['name', 'id'])}, {'after': json_cursor([1])}):
+            with self.subTest(query):
+                self.assertEqual(self.client.get(reverse('local_files'), query).status_code, 404)
+
+
+class NameIndexTest(TestCase):
+    queries = ['', 'a', 'mo', 'movie', 'MOVIE', 'ie 1', '.mkv', 'txt', 'Ünï', 'missing']
+
+    def setUp(self):
+        self.storages = [Storage.objects.create(path=f'/storage{number}') for number in range(3)]
+        names = ['Movie 1.mkv', 'movie 10.mkv', 'a.txt', 'Ünïcode.txt', 'movie 1.mkv', 'A.TXT', 'notes about movies']
+        for number in range(60):
+            name = names[number % len(names)]
+            storage = self.storages[number % 3]
+            File.objects.create(
+                name=name, path=f'{storage.path}/{number}', file_hash=sha(str(number).encode()), size=number,
+                storage=storage, hidden=number % 11 == 0
+            )
+        self.index = name_index.NameIndex()
+        self.index.sync()
+
+    def check(self):
+        fields = ['name', 'size', 'file_hash']
+        for query in self.queries:
+            with self.subTest(query):
+                expected = list(search_rows(query, fields))
+                self.assertEqual(self.index.search(query, fields), expected)
+                for count in (1, 5):
+                    self.assertEqual(self.index.search(query, fields, count=count), expected[:count])
+                if len(expected) > 3:
+                    cursor = (expected[2]['name'], expected[2]['id'])
+                    self.assertEqual(self.index.search(query, fields, cursor), list(search_rows(query, fields, cursor)))
+
+    def test_matches_database(self):
+        self.check()
+
+    def test_follows_changes(self):
+        storage = self.storages[0]
+        File.objects.filter(storage=storage, name='a.txt').delete()
+        File.objects.create(name='new movie.mkv', path='/storage0/new', file_hash=sha(b'new'), storage=storage)
+        File.objects.filter(storage=self.storages[1]).update(name='renamed')
+        name_index.touch(storage.id)
+        name_index.touch(self.storages[1].id)
+        Storage.objects.filter(id=self.storages[2].id).update(hidden=True)
+        self.assertEqual(sorted(self.index.sync()), [storage.id, self.storages[1].id])
+        self.check()
+        # dead slots are gone from a compacted copy, the results stay the same
+        self.index = self.index.compacted()
+        self.check()
+
+    def test_sync_without_changes(self):
+        order = self.index.order
+        self.assertEqual(self.index.sync(), [])
+        self.assertIs(self.index.order, order)
+        Storage.objects.filter(id=self.storages[0].id).update(hidden=True)
+        self.index.sync()
+        self.assertIs(self.index.order, order)
+        self.check()
+
+    def test_one_changed_file(self):
+        storage = self.storages[0]
+        slots = len(self.index.ids)
+        File.objects.filter(storage=storage, name='a.txt').update(size=1000)
+        File.objects.create(name='new movie.mkv', path='/storage0/new', file_hash=sha(b'new'), storage=storage)
+        name_index.touch(storage.id, added=1)
+        self.index.sync()
+        # the other files of the storage keep their slots
+        changed = File.objects.filter(storage=storage, name='a.txt', hidden=False).count()
+        self.assertEqual(len(self.index.ids), slots + changed + 1)
+        self.assertEqual(self.index.dead, changed)
+        self.check()
+
+    def test_wrong_cursor(self):
+        with self.assertRaises(ValueError):
+            self.index.search('movie', ['name'], ('movie', '1'))
+
+
+class BloomSummaryTest(TestCase):
+    def setUp(self):
+        # the summary is kept per version, ids of rolled back tests come again with the same version
+        summary._summary[:] = None, None
+
+    def test_no_false_negatives(self):
+        items = [f'item {number}' for number in range(2000)]
+        # a filter capped far below the optimal size gets more false positives, never a false negative
+        for max_bytes in (16, 256, 1 << 20):
+            with self.subTest(max_bytes=max_bytes):
+                bloom = BloomFilter.for_items(len(items), 0.01, max_bytes)
+                for item in items:
+                    bloom.add(item)
+                copy = BloomFilter.from_dict(bloom.to_dict())
+                self.assertTrue(all(item in bloom and item in copy for item in items))
+        bloom = BloomFilter.for_items(len(items), 0.01, 1 << 20)
+        for item in items:
+            bloom.add(item)
+        false_positives = sum(f'other {number}' in bloom for number in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_broken_filter(self):
+        for data in ({'size': 64, 'hash_count': 1, 'bits': 'AA=='}, {'size': 8, 'hash_count': 0, 'bits': 'AA=='}):
+            with self.subTest(data):
+                with self.assertRaises(ValueError):
+                    BloomFilter.from_dict(data)
+
+    def test_summary_covers_every_shared_file(self):
+        storage = Storage.objects.create(path='/storage')
+        names = ['Movie 1.mkv', 'notes.txt', 'Ünïcode файл.bin', 'ab']
+        for name in names:
+            File.objects.create(name=name, path=f'/storage/{name}', file_hash=sha(name.encode()), storage=storage)
+        response = self.client.get(reverse('summary'))
+        self.assertEqual(response.status_code, 200)
+        peer = summary.parse_summary(response.json())
+        for name in names:
+            self.assertTrue(peer.might_have(summary.hash_items(sha(name.encode()))))
+            for start in range(len(name)):
+                for end in range(start + 1, len(name) + 1):
+                    search_str = name[start:end].upper()
+                    self.assertTrue(peer.might_have(summary.name_items(search_str)), search_str)
+
+    def test_plan_does_not_wait_for_summaries(self):
+        bloom = BloomFilter.for_items(10, 0.01, 1024)
+        for item in summary.name_items('alpha'):
+            bloom.add(item)
+        self.addCleanup(summary._peers.clear)
+        summary._peers.update({'10.0.0.1': summary.PeerSummary('1', bloom), '10.0.0.2': summary.PeerSummary()})
+        ask, check, load = summary.plan(['10.0.0.1', '10.0.0.2', '10.0.0.3'], summary.name_items('alpha'))
+        self.assertEqual((ask, check, load), (['10.0.0.1', '10.0.0.2', '10.0.0.3'], [], ['10.0.0.3']))
+        # only a summary ruling the name out is checked first
+        ask, check, load = summary.plan(['10.0.0.1', '10.0.0.2'], summary.name_items('beta'))
+        self.assertEqual((ask, check, load), (['10.0.0.2'], ['10.0.0.1'], []))
+        with mock.patch.object(summary, 'refresh_peer', lambda address: summary.store_answer(address, 304, None)):
+            self.assertIs(summary.check_peer('10.0.0.1', summary.name_items('beta')), False)
+        # an unreachable peer is asked anyway
+        with mock.patch.object(summary, 'refresh_peer', lambda address: None):
+            self.assertIs(summary.check_peer('10.0.0.1', summary.name_items('beta')), True)
+
+    def test_version(self):
+        storage = Storage.objects.create(path='/storage')
+        version = self.client.get(reverse('summary')).json()['version']
+        self.assertEqual(self.client.get(reverse('summary'), {'version': version}).status_code, 304)
+        File.objects.create(name='new.txt', path='/storage/new.txt', file_hash=sha(b'new'), storage=storage)
+        name_index.touch(storage.id, added=1)
+        response = self.client.get(reverse('summary'), {'version': version})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(summary.parse_summary(response.json()).might_have(summary.name_items('new')))
+
+
+class HashLookupTest(TestCase):
+    def setUp(self):
+        storage = Storage.objects.create(path='/storage')
+        hidden_storage = Storage.objects.create(path='/hidden', hidden=True)
+        for name in ('a', 'b', 'a copy'):
+            file_hash = sha(name[0].encode())
+            File.objects.create(name=name, path=f'/storage/{name}', file_hash=file_hash, size=1, storage=storage)
+        File.objects.create(name='c', path='/storage/c', file_hash=sha(b'c'), size=1, storage=storage, hidden=True)
+        File.objects.create(name='d', path='/hidden/d', file_hash=sha(b'd'), size=1, storage=hidden_storage)
+
+    def lookup(self, data):
+        return self.client.post(reverse('hashes'), json.dumps(data), content_type='application/json')
+
+    def test_found_hashes(self):
+        response = self.lookup({'hashes': [sha(name.encode()) for name in 'abcde'] + [sha(b'a')]})
+        self.assertEqual(response.status_code, 200)
+        files = response.json()['files']
+        # one shared copy per hash, hidden files and storages are not shared
+        self.assertEqual(sorted(file['file_hash'] for file in files), sorted([sha(b'a'), sha(b'b')]))
+        self.assertEqual(set(files[0]), {'name', 'size', 'file_hash'})
+
+    def test_wrong_input(self):
+        for data in ({}, {'hashes': 'a'}, {'hashes': [1]}, {'hashes': [None]}, ['a'], {'hashes': {'a': 1}}):
+            with self.subTest(data):
+                self.assertEqual(self.lookup(data).status_code, 400)
+
+    def test_too_many_hashes(self):
+        self.assertEqual(self.lookup({'hashes': ['x'] * (HASH_LOOKUP_MAX + 1)}).status_code, 400)
+        self.assertEqual(self.lookup({'hashes': ['x'] * HASH_LOOKUP_MAX}).json(), {'files': []})
+
+
+class PeerAnswerTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(summary, 'refresh_peer', lambda address: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def answer(self, method, body, content_type='application/json'):
+        response = mock.MagicMock(headers={'Content-Type': content_type})
+        response.__enter__.return_value = response
+        response.json.return_value = body
+        response.iter_lines.return_value = [json.dumps(body).encode()]
+        return mock.patch.object(peers.http_client, method, return_value=response)
+
+    def test_malformed_search_answers(self):
+        for body, content_type in (
+            ({'files': None}, 'application/json'),
+            ([{'name': 'a'}], 'application/json'),
+            (5, 'application/x-ndjson'),
+        ):
+            with self.subTest(body=body), self.answer('get', body, content_type):
+                search = peers.PeerSearch(['10.0.0.1'], 'alpha', use_cache=False)
+                self.assertEqual(list(search), [])
+                self.assertEqual(search.failed, ['10.0.0.1'])
+
+    def test_malformed_hash_answers(self):
+        for body in ({'files': None}, [1, 2], 5):
+            with self.subTest(body=body), self.answer('post', body):
+                lookup = peers.HashLookup(['10.0.0.1'], [sha(b'a')])
+                self.assertEqual(lookup.run(), {})
+                self.assertEqual(lookup.failed, ['10.0.0.1'])
+
+
+class MetricsTest(TestCase):
+    def test_local_scraper(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    def test_forwarded_by_proxy(self):
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_X_FORWARDED_FOR='10.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_X_REAL_IP='10.0.0.1').status_code, 403)
+        self.client.force_login(User.objects.create_user('user'))
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_X_FORWARDED_FOR='10.0.0.1').status_code, 200)
+
+    def test_slow_peer_logged(self):
+        with mock.patch.object(metrics, 'PEER_SLOW_SECONDS', 0), self.assertLogs('client_app.metrics') as logs:
+            with metrics.time_peer('10.0.0.1', 'search'):
+                pass
+        self.assertIn('search request to 10.0.0.1', logs.output[0])
+        self.assertNotIn('10.0.0.1', metrics.render())
+
+
+class SwarmTest(TestCase):
+    content = b'0123456789'
+    piece_size = 4
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.path = os.path.join(root, 'file.swarm')
+        self.broken = set()
+        self.fetched = []
+        # one worker takes the pieces in a fixed order
+        for patcher in (
+            mock.patch.object(swarm, 'SWARM_WORKERS', 1),
+            mock.patch.object(swarm.Swarm, 'fetch_piece', autospec=True, side_effect=self.fetch_piece),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetch_piece(self, loader, index, peer):
+        self.fetched.append((index, peer))
+        if peer in self.broken:
+            raise swarm.PieceError(f'{peer} is broken')
+        start, end = loader.piece_range(index)
+        return start, self.content[start:end + 1]
+
+    def run_swarm(self, peers):
+        pieces = [sha(self.content[start:start + self.piece_size]) for start in range(0, 10, self.piece_size)]
+        loader = swarm.Swarm(
+            {peer: 'file' for peer in peers}, sha(self.content), len(self.content), pieces, self.piece_size,
+            self.path, downloads.TransferProgress()
+        )
+        loader.run()
+        return loader
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_new_file_is_not_hashed(self):
+        with mock.patch.object(swarm.Swarm, 'check_existing') as check_existing:
+            self.run_swarm(['10.0.0.1'])
+        check_existing.assert_not_called()
+        self.assertEqual(self.read(), self.content)
+        self.assertEqual(sorted(index for index, _ in self.fetched), [0, 1, 2])
+
+    def test_resume_loads_missing_pieces(self):
+        write_file(self.path, b'0123xxxx89')
+        self.run_swarm(['10.0.0.1'])
+        self.assertEqual(self.read(), self.content)
+        self.assertEqual(self.fetched, [(1, '10.0.0.1')])
+
+    def test_failed_pieces_go_to_other_peers(self):
+        self.broken.add('10.0.0.1')
+        loader = self.run_swarm(['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(self.read(), self.content)
+        self.assertEqual(loader.failures, {'10.0.0.1': SWARM_MAX_PEER_FAILURES, '10.0.0.2': 0})
+        loaded = [index for index, peer in self.fetched if peer == '10.0.0.2']
+        self.assertEqual(sorted(loaded), [0, 1, 2])
+
+    def test_peer_failure_limit(self):
+        self.broken.update(['10.0.0.1', '10.0.0.2'])
+        with self.assertRaises(downloads.DownloadError):
+            self.run_swarm(['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(len(self.fetched), 2 * SWARM_MAX_PEER_FAILURES)
+        # the next attempt hashes what the file already holds
+        self.broken.clear()
+        self.fetched.clear()
+        self.run_swarm(['10.0.0.1'])
+        self.assertEqual(self.read(), self.content)
+        self.assertEqual(sorted(index for index, _ in self.fetched), [0, 1, 2])
+
+    def test_parse_piece_list(self):
+        pieces = ['a' * 64, 'b' * 64, 'c' * 64]
+        self.assertEqual(swarm.parse_piece_list({'size': 10, 'pieces': pieces}, 4), (10, pieces))
+        self.assertEqual(swarm.parse_piece_list({'size': 0, 'pieces': []}, 4), (0, []))
+        for data in (
+            {'size': 12, 'pieces': pieces + ['d' * 64]},
+            {'size': 10, 'pieces': pieces[:2]},
+            {'size': '10', 'pieces': pieces},
+            {'size': 10, 'pieces': 'abc'},
+            {'size': 10, 'pieces': ['a' * 64, 'b' * 63, 'c' * 64]},
+            {'size': 10, 'pieces': ['a' * 64, None, 'c' * 64]},
+        ):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                swarm.parse_piece_list(data, 4)
+        with self.assertRaises(KeyError):
+            swarm.parse_piece_list({'size': 10}, 4)
+
+
+class SettingsCacheTest(TestCase):
+    def setUp(self):
+        # the cache outlives the rolled back test data
+        invalidate_settings()
+        self.addCleanup(invalidate_settings)
+
+    def settings_queries(self, queries):
+        return [query['sql'] for query in queries if Settings._meta.db_table in query['sql']]
+
+    def test_write_is_visible_at_once(self):
+        save_setting('login', 'first')
+        self.assertEqual(get_setting('login'), 'first')
+        save_setting('login', 'second')
+        self.assertEqual(get_setting('login'), 'second')
+        Settings.objects.filter(name='login').delete()
+        self.assertIsNone(get_setting('login'))
+
+    def test_unchanged_values_are_not_written(self):
+        save_settings({'login': 'user', 'server': '10.0.0.1'})
+        get_setting('login')
+        # only the read of the current values
+        with self.assertNumQueries(1):
+            save_settings({'login': 'user', 'server': '10.0.0.1'})
+        with CaptureQueriesContext(connection) as queries:
+            get_setting('login')
+        self.assertEqual(self.settings_queries(queries), [])
+
+    def test_page_render_reads_settings_once(self):
+        save_settings({'login': 'user', 'is_online': 'True'})
+        self.assertEqual(self.client.get(reverse('main_page')).status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('main_page'))
+        self.assertContains(response, 'user')
+        self.assertEqual(self.settings_queries(queries), [])
+
+
+class DownloadClaimTest(TestCase):
+    def transfer(self, ip, file_hash='0' * 64, status=Transfer.QUEUED, sources=''):
+        return Transfer.objects.create(ip=ip, name='file', file_hash=file_hash, status=status, sources=sources)
+
+    def test_claim(self):
+        transfer = self.transfer('10.0.0.1')
+        self.assertIs(tasks.claim_transfer(transfer), True)
+        transfer.refresh_from_db()
+        self.assertEqual((transfer.status, transfer.sources), (Transfer.RUNNING, '10.0.0.1'))
+        # not queued anymore
+        self.assertIsNone(tasks.claim_transfer(transfer))
+
+    def test_per_peer_limit_counts_every_source(self):
+        self.transfer('10.0.0.1', '1' * 64, Transfer.RUNNING, '10.0.0.1 10.0.0.2')
+        self.assertIs(tasks.claim_transfer(self.transfer('10.0.0.1')), False)
+        self.assertIs(tasks.claim_transfer(self.transfer('10.0.0.2', '2' * 64)), False)
+        transfer = self.transfer('10.0.0.3', '3' * 64)
+        self.assertIs(tasks.claim_transfer(transfer), True)
+        # a swarm download only adds the clients nobody else loads from
+        sources = tasks.claim_sources(transfer, ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4'])
+        self.assertEqual(sources, ['10.0.0.3', '10.0.0.4'])
+        self.assertEqual(Transfer.objects.get(id=transfer.id).sources, '10.0.0.3 10.0.0.4')
+
+    def test_active_limit(self):
+        for number in range(DOWNLOAD_MAX_ACTIVE):
+            self.transfer(f'10.0.1.{number}', f'{number:064x}', Transfer.RUNNING)
+        self.assertIs(tasks.claim_transfer(self.transfer('10.0.0.1', 'f' * 64)), False)
+
+    def test_one_download_per_file(self):
+        self.transfer('10.0.0.1', status=Transfer.RUNNING)
+        self.assertIs(tasks.claim_transfer(self.transfer('10.0.0.2')), False)
+
+    def test_stale_transfer_is_reset(self):
+        stale = self.transfer('10.0.0.1', '1' * 64, Transfer.RUNNING)
+        Transfer.objects.filter(id=stale.id).update(
+            updated=timezone.now() - timedelta(seconds=DOWNLOAD_STALE_AFTER + 1)
+        )
+        alive = self.transfer('10.0.0.2', '2' * 64, Transfer.RUNNING)
+        self.assertIs(tasks.claim_transfer(self.transfer('10.0.0.1')), True)
+        self.assertEqual(Transfer.objects.get(id=stale.id).status, Transfer.FAILED)
+        self.assertEqual(Transfer.objects.get(id=alive.id).status, Transfer.RUNNING)
+
+    def test_queue_download_once(self):
+        first = tasks.queue_download(Transfer(ip='10.0.0.1', name='file', file_hash='0' * 64))
+        second = tasks.queue_download(Transfer(ip='10.0.0.2', name='file', file_hash='0' * 64))
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(Transfer.objects.count(), 1)
+        # a failed one is not retried while another loads the file
+        failed = self.transfer('10.0.0.3', status=Transfer.FAILED)
+        self.assertEqual(tasks.queue_download(failed).id, first.id)
+        self.assertEqual(Transfer.objects.get(id=failed.id).status, Transfer.FAILED)
+
+
+class StorageWatcherTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.nested_path = os.path.join(self.root, 'nested')
+        write_file(os.path.join(self.root, 'a.txt'), b'a')
+        write_file(os.path.join(self.nested_path, 'b.txt'), b'b')
+        self.parent = Storage.objects.create(path=self.root)
+        self.nested = Storage.objects.create(path=self.nested_path + '/')
+        self.watcher = StorageWatcher(debounce=0)
+        self.addCleanup(self.watcher.inotify.close)
+        self.watcher.storages = [self.parent, self.nested]
+
+    def names(self, storage):
+        return sorted(File.objects.filter(storage=storage).values_list('name', flat=True))
+
+    def test_get_storage(self):
+        for path, storage in (
+            (self.root, self.parent), (os.path.join(self.root, 'a.txt'), self.parent),
+            (self.nested_path, self.nested), (os.path.join(self.nested_path, 'b.txt'), self.nested),
+            (self.nested_path + 'x', self.parent), ('/elsewhere', None),
+        ):
+            with self.subTest(path):
+                self.assertEqual(self.watcher.get_storage(path), storage)
+
+    def test_events_go_to_their_storage(self):
+        self.watcher.watch_tree(self.root)
+        write_file(os.path.join(self.root, 'c.txt'), b'c')
+        # touching the root of the nested storage must not index its files under the parent
+        os.utime(self.nested_path)
+        events = self.watcher.inotify.read(timeout=1)
+        self.assertTrue(events)
+        for event in events:
+            self.watcher.handle(event)
+        self.watcher.flush()
+        self.assertEqual(self.names(self.parent), ['c.txt'])
+        self.assertEqual(self.names(self.nested), ['b.txt'])
+
+    def test_skip_dirs_of_paths(self):
+        scan_storage(self.parent, {self.nested_path}, paths=[self.nested_path, self.root])
+        self.assertEqual(self.names(self.parent), ['a.txt'])
 
-# Create your tests here.
+    def test_waits_for_pending_scan(self):
+        tasks.queue_storage_scan(self.parent)
+        path = os.path.join(self.root, 'a.txt')
+        self.watcher.dirty[path] = 0
+        self.watcher.flush()
+        self.assertEqual(self.names(self.parent), [])
+        self.assertIn(path, self.watcher.dirty)
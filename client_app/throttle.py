@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import time
+
+from client.settings import DOWNLOAD_RATE_LIMIT, UPLOAD_RATE_LIMIT
+
+
+class TokenBucket:
+    # rate in bytes per second shared by every thread of the process, 0 means no limit
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        # seconds to wait before sending amount bytes
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # going into debt makes the next callers wait as well
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def consume(self, amount):
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+    async def consume_async(self, amount):
+        wait = self.reserve(amount)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+download_bucket = TokenBucket(DOWNLOAD_RATE_LIMIT)
+upload_bucket = TokenBucket(UPLOAD_RATE_LIMIT)
+
+
+def iter_throttled(chunks, bucket):
+    for chunk in chunks:
+        bucket.consume(len(chunk))
+        yield chunk
+
+
+async def aiter_throttled(chunks, bucket):
+    try:
+        async for chunk in chunks:
+            await bucket.consume_async(len(chunk))
+            yield chunk
+    finally:
+        await chunks.aclose()
@@ -10,6 +10,7 @@ urlpatterns = [
     path('storage/<int:storage_id>/delete', views.delete_storage, name='delete_storage'),
     path('storage/<int:storage_id>/hide_show', views.hide_show_storage, name='hide_show_storage'),
     path('storage/refresh', views.refresh_storage_files, name='refresh_storage_files'),
+    path('storage/progress', views.storage_scan_progress, name='storage_scan_progress'),
     path('login', views.login_on_server, name='login'),
 
     path('local', views.LocalFiles.as_view(), name='local_files'),
@@ -19,8 +20,14 @@ urlpatterns = [
     path('search', views.search_file, name='search_file'),
     path('outer', views.search_outer_files, name='outer_files'),
     path('getfile', views.get_file_to_outer, name='getfile'),
+    path('pieces', views.get_file_pieces, name='pieces'),
+    path('summary', views.get_file_summary, name='summary'),
+    path('hashes', views.lookup_file_hashes, name='hashes'),
+    path('metrics', views.metrics_view, name='metrics'),
     path('outer/load', views.load_file_and_store, name='load_outer'),
     path('outer/get', views.load_file_and_return, name='get_outer'),
+    path('transfers', views.TransferView.as_view(), name='transfers'),
+    path('transfers/<int:transfer_id>/retry', views.retry_transfer, name='retry_transfer'),
 
     path('auth', views.OurLoginView.as_view(template_name = 'client_app/auth.html'), name='auth'),
     path('logout', auth_views.LogoutView.as_view(next_page='/auth'), name='logout'),
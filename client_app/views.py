@@ -1,4 +1,3 @@
-import hashlib
 import mimetypes
 import os
 
@@ -6,24 +5,38 @@ import requests
 from django.contrib.auth import views as auth_views
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponse, HttpResponseServerError
+from django.db.models import Sum
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotModified,
+    HttpResponseServerError, JsonResponse, StreamingHttpResponse
+)
 from django.shortcuts import redirect, render, get_object_or_404
 from django.urls import reverse_lazy
 from django.views import generic
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from client.settings import SERVER_PORT, CLIENT_PORT, MEDIA_ROOT
+from client.settings import (
+    SERVER_PORT, CLIENT_PORT, MEDIA_ROOT, HASH_LOOKUP_MAX, METRICS_ALLOWED_IPS, SWARM_PIECE_SIZE
+)
+from client_app import dedup, downloads, http_client, metrics, name_index, outer_cache, summary, swarm
 from client_app.forms import StorageForm, LoginForm
-from client_app.helper import save_setting, get_setting
-from client_app.models import Storage, File
-from client_app.serializers import OuterFileSerializer
+from client_app.helper import save_setting, save_settings, get_setting
+from client_app.models import Storage, File, StorageScan, Transfer
+from client_app.pagination import KeysetPaginationMixin, estimate_rows
+from client_app.peers import PeerSearch, ServerError, get_online_clients
+from client_app.search import SearchError, find_hashes, parse_search_params, search_lines, search_page
+from client_app.serving import serve_file
+from client_app.tasks import (
+    queue_download, queue_parent_scans, queue_piece_hashes, queue_storage_scan, reset_stale_transfers
+)
 
 
 def get_login_info():
     return {
         'login': get_setting('login'),
-        'is_online': get_setting('is_online')
+        'is_online': get_setting('is_online'),
+        'ping_latency': get_setting('ping_latency'),
     }
 
 
@@ -42,10 +55,9 @@ class ListViewWithLoginInfo(generic.ListView):
         return context
 
 
-class StorageView(LoginRequiredMixin, ListViewWithLoginInfo):
-    queryset = Storage.objects.all()
-    ordering = ['date']
-    paginate_by = 10
+class StorageView(LoginRequiredMixin, KeysetPaginationMixin, ListViewWithLoginInfo):
+    queryset = Storage.objects.select_related('scan')
+    ordering = ['date', 'id']
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
@@ -61,17 +73,6 @@ def hide_show_storage(request, storage_id):
     return redirect('storage')
 
 
-def get_all_files(path):
-    result = []
-    for elem in os.listdir(path):
-        full_path = os.path.join(path, elem)
-        if os.path.isdir(full_path):
-            result += get_all_files(full_path)
-        else:
-            result.append(full_path)
-    return result
-
-
 @login_required()
 def refresh_storage_files(request):
     # check if we have MEDIA in storages
@@ -79,36 +80,45 @@ def refresh_storage_files(request):
         Storage.objects.create(path=MEDIA_ROOT)
 
     for storage in Storage.objects.all():
-        for file in get_all_files(storage.path):
-            if File.objects.filter(path=file).exists():
-                continue
-            file_obj, _ = File.objects.get_or_create(path=file, storage=storage)
-            file_obj.name = os.path.basename(file)
-            file_obj.size = os.path.getsize(file)
-            with open(file, 'rb') as opened_file:
-                file_obj.file_hash = hashlib.sha256(opened_file.read()).hexdigest()
-            file_obj.save()
-    for file in File.objects.all():
-        if not os.path.exists(file.path):
-            file.delete()
+        queue_storage_scan(storage)
     return redirect('storage')
 
 
+@login_required()
+def storage_scan_progress(request):
+    scans = []
+    for scan in StorageScan.objects.all():
+        scans.append({
+            'storage': scan.storage_id,
+            'status': scan.status,
+            'files_seen': scan.files_seen,
+            'files_to_hash': scan.files_to_hash,
+            'files_hashed': scan.files_hashed,
+            'bytes_to_hash': scan.bytes_to_hash,
+            'bytes_hashed': scan.bytes_hashed,
+            'eta': scan.eta(),
+        })
+    return JsonResponse({'scans': scans})
+
+
 @login_required()
 def add_storage(request):
     if request.method == 'POST':
         form = StorageForm(request.POST)
         if form.is_valid():
-            form.save()
-            return refresh_storage_files(request)
+            storage = form.save()
+            queue_storage_scan(storage)
+            queue_parent_scans(storage)
     return redirect('storage')
 
 
 @login_required()
 def delete_storage(request, storage_id):
+    # files of the storage go away with it
     storage = Storage.objects.filter(id=storage_id).get()
     storage.delete()
-    return refresh_storage_files(request)
+    queue_parent_scans(storage)
+    return redirect('storage')
 
 
 @login_required()
@@ -116,31 +126,22 @@ def login_on_server(request):
     if request.method == 'POST':
         form = LoginForm(request.POST)
         if form.is_valid():
-            save_setting('login', form.cleaned_data['login'])
-            save_setting('password', form.cleaned_data['password'])
-            save_setting('server', form.cleaned_data['server'])
+            save_settings({
+                'login': form.cleaned_data['login'],
+                'password': form.cleaned_data['password'],
+                'server': form.cleaned_data['server'],
+            })
+            outer_cache.invalidate()
             try:
-                response = requests.post(
+                response = http_client.post(
                     f'http://{form.cleaned_data["server"]}:{SERVER_PORT}/auth',
                     data={
                         'username': form.cleaned_data['login'],
                         'password': form.cleaned_data['password'],
                     }
                 )
-                if response.status_code == 200:
-                    save_setting('token', response.json()['token'])
-                else:
-                    return render(
-                        request,
-                        'client_app/login.html',
-                        {
-                            'form': form,
-                            'error_text': f'Wrong answer from {form.cleaned_data["server"]} : {response.status_code}',
-                            **get_login_info()
-                        }
-                    )
-                return redirect('storage')
-            except requests.exceptions.ConnectionError:
+            except requests.exceptions.RequestException:
+                # timeouts and exhausted retries of the shared session as well
                 return render(
                     request,
                     'client_app/login.html',
@@ -150,6 +151,22 @@ def login_on_server(request):
                         **get_login_info()
                     }
                 )
+            try:
+                token = response.json()['token'] if response.status_code == 200 else None
+            except (ValueError, KeyError, TypeError):
+                token = None
+            if not token:
+                return render(
+                    request,
+                    'client_app/login.html',
+                    {
+                        'form': form,
+                        'error_text': f'Wrong answer from {form.cleaned_data["server"]} : {response.status_code}',
+                        **get_login_info()
+                    }
+                )
+            save_setting('token', token)
+            return redirect('storage')
     else:
         form = LoginForm(initial={'server': get_setting('server'), 'login': get_setting('login')})
     return render(
@@ -163,22 +180,23 @@ def login_on_server(request):
 
 
 # Inner storage
-class LocalFiles(LoginRequiredMixin, ListViewWithLoginInfo):
+class LocalFiles(LoginRequiredMixin, KeysetPaginationMixin, ListViewWithLoginInfo):
     queryset = File.objects.all()
     template_name = 'client_app/local_files.html'
-    paginate_by = 10
-    ordering = ['name']
+    ordering = ['name', 'id']
 
-    def get_context_data(self, *args, **kwargs):
-        context = super().get_context_data(*args, **kwargs)
-        return context
+    def get_approximate_count(self):
+        # only the total of all files is known without counting, not the number of search results
+        if self.request.GET.get('search'):
+            return None
+        return estimate_rows(File) or Storage.objects.aggregate(count=Sum('files_count'))['count'] or 0
 
     def get_queryset(self):
         filtering = self.request.GET['search'] if 'search' in self.request.GET else ''
         self.queryset = (
             File
             .objects
-            .filter(name__contains=filtering)
+            .filter(name__icontains=filtering)
         )
         return super().get_queryset()
 
@@ -188,21 +206,18 @@ def hide_show_file(request, file_id):
     file = File.objects.filter(id=file_id).get()
     file.hidden = not file.hidden
     file.save()
+    name_index.touch(file.storage_id)
     return redirect('local_files')
 
 
 @login_required()
 def download_file(request, file_id):
-    file = File.objects.get(id=file_id)
-    mime_type, _ = mimetypes.guess_type(file.path)
-
-    fl = open(file.path, 'r')
-    response = HttpResponse(fl, content_type=mime_type)
-    response['Content-Disposition'] = f"attachment; filename={file.name}"
-    return response
+    file = get_object_or_404(File, id=file_id)
+    return serve_file(request, file, as_attachment=True)
 
 
 # Outer storage
+@metrics.outer_search_seconds.time()
 def get_outer_storage_file_info(search_str):
     # get online users
     server = get_setting('server')
@@ -210,53 +225,53 @@ def get_outer_storage_file_info(search_str):
     my_user = get_setting('login')
     if not server or not token:
         return [], 'Try to log in first'
-    response = requests.get(f'http://{server}:{SERVER_PORT}/online', headers={'Authorization': f'TOKEN {token}'})
-    if response.status_code != 200:
-        return [], f'Error connecting to server: {response.status_code}'
-    if not response.json() or 'available' not in response.json():
-        return [], f'Server returned empty response.'
+    try:
+        available = get_online_clients(server, token)
+    except ServerError as e:
+        return [], str(e)
+    addresses = [client['address'] for client in available if client['user'] != my_user]
+    search = PeerSearch(addresses, search_str)
     found_files = []
-    for client in response.json()['available']:
-        if client['user'] == my_user:
-            continue
-        client_response = requests.get(
-            f'http://{client["address"]}:{CLIENT_PORT}/search',
-            params={'search_str': search_str}
-        )
-        # ignore errors - if something happened - well, good luck next time
-        if client_response.status_code == 200:
-            for file in client_response.json()['files']:
-                found_file = OuterFileSerializer(data=file)
-                if found_file.is_valid():
-                    result_dict = found_file.data
-                    result_dict['url'] = client['address']
-                    found_files.append(result_dict)
+    # ignore errors - if something happened - well, good luck next time
+    for _, files in search:
+        found_files.extend(files)
+    timeout_text = f'No answer from: {", ".join(search.timed_out)}' if search.timed_out else ''
     if not found_files:
-        return [], 'No files found!'
-    return found_files, ''
+        return [], timeout_text or 'No files found!'
+    return found_files, timeout_text
 
 
 @api_view(['GET'])
 def search_file(request):
     if 'search_str' not in request.GET:
         return HttpResponseServerError('Cannot find parameter "search_str"')
-    return_files = []
-    files_queryset = (
-        File
-        .objects
-        .filter(
-            name__contains=request.GET['search_str'],
-            hidden=False,
-            storage__hidden=False
+    try:
+        limit, fields, cursor = parse_search_params(request.GET)
+    except SearchError as e:
+        return HttpResponseBadRequest(str(e))
+    if request.GET.get('stream') == '1':
+        return StreamingHttpResponse(
+            search_lines(request.GET['search_str'], limit, fields, cursor),
+            content_type='application/x-ndjson'
         )
-    )
-    for file in files_queryset:
-        return_files.append(OuterFileSerializer(file).data)
+    files, next_cursor = search_page(request.GET['search_str'], limit, fields, cursor)
     return Response({
-        'files': return_files
+        'files': files,
+        'next': next_cursor
     })
 
 
+@api_view(['POST'])
+def lookup_file_hashes(request):
+    # which of the hashes this client shares, for many files in one request
+    hashes = request.data.get('hashes') if isinstance(request.data, dict) else None
+    if not isinstance(hashes, list) or not all(isinstance(file_hash, str) for file_hash in hashes):
+        return HttpResponseBadRequest('"hashes" must be a list of strings')
+    if len(hashes) > HASH_LOOKUP_MAX:
+        return HttpResponseBadRequest(f'At most {HASH_LOOKUP_MAX} hashes in one request')
+    return Response({'files': find_hashes(hashes)})
+
+
 @login_required()
 def search_outer_files(request):
     if 'search_str' not in request.GET:
@@ -273,19 +288,69 @@ def search_outer_files(request):
     )
 
 
+def get_shared_file(**filters):
+    # the same file can be in several storages, any visible copy will do
+    file = File.objects.filter(hidden=False, storage__hidden=False, **filters).first()
+    if file is None:
+        raise Http404('File not found')
+    return file
+
+
 @api_view(['GET'])
 def get_file_to_outer(request):
     if 'name' not in request.GET or 'file_hash' not in request.GET:
         return HttpResponseServerError('Required fields "name" and "file_hash" are empty')
 
-    file = get_object_or_404(File, name=request.GET['name'], file_hash=request.GET['file_hash'])
-    fl = open(file.path, 'rb')
-    response = HttpResponse(fl)
-    return response
+    file = get_shared_file(name=request.GET['name'], file_hash=request.GET['file_hash'])
+    return serve_file(request, file)
+
+
+@api_view(['GET'])
+def get_file_pieces(request):
+    if 'file_hash' not in request.GET or 'piece_size' not in request.GET:
+        return HttpResponseServerError('Required fields "file_hash" and "piece_size" are empty')
+    try:
+        piece_size = int(request.GET['piece_size'])
+    except ValueError:
+        return HttpResponseBadRequest('"piece_size" must be a number')
+    # only one piece size is hashed, any other would mean reading the whole file again
+    if piece_size != SWARM_PIECE_SIZE:
+        return HttpResponseBadRequest(f'"piece_size" must be {SWARM_PIECE_SIZE}')
+
+    file = get_shared_file(file_hash=request.GET['file_hash'])
+    pieces = swarm.get_piece_hashes(file.file_hash, piece_size)
+    if pieces is None:
+        # hashed in the background, the client asks again
+        queue_piece_hashes(file.file_hash)
+        return Response({'size': file.size, 'piece_size': piece_size}, status=202)
+    return Response({
+        'size': file.size,
+        'piece_size': piece_size,
+        'pieces': pieces
+    })
+
+
+@api_view(['GET'])
+def get_file_summary(request):
+    # peers send the version they have, an unchanged summary is not sent again
+    version = summary.get_version()
+    if request.GET.get('version') == version:
+        return HttpResponseNotModified()
+    return Response(summary.get_summary(version))
+
+
+def metrics_view(request):
+    # Prometheus text format, for local scrapers and logged in users only. A request passed on by a front proxy
+    # comes from its address, the forwarding headers tell it from the local scraper
+    forwarded = any(header in request.META for header in ('HTTP_X_FORWARDED_FOR', 'HTTP_X_REAL_IP', 'HTTP_FORWARDED'))
+    local = request.META.get('REMOTE_ADDR') in METRICS_ALLOWED_IPS and not forwarded
+    if not local and not request.user.is_authenticated:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 def load_file_from_outer(ip, name, file_hash):
-    response = requests.get(
+    response = http_client.get(
         f'http://{ip}:{CLIENT_PORT}/getfile',
         params={'name': name, 'file_hash': file_hash},
         stream=True
@@ -297,20 +362,48 @@ def load_file_from_outer(ip, name, file_hash):
 
 @login_required()
 def load_file_and_store(request):
-    raw_resp, _ = load_file_from_outer(request.GET['ip'], request.GET['name'], request.GET['file_hash'])
-    full_path = os.path.join(MEDIA_ROOT, request.GET['name'])
-    with open(full_path, 'wb') as f:
-        for chunk in raw_resp.iter_content(chunk_size=1024):
-            f.write(chunk)
-
-    file_obj, _ = File.objects.get_or_create(path=full_path, storage=Storage.objects.get(path=MEDIA_ROOT))
-    file_obj.name = request.GET['name']
-    file_obj.size = os.path.getsize(full_path)
-    with open(full_path, 'rb') as opened_file:
-        file_obj.file_hash = hashlib.sha256(opened_file.read()).hexdigest()
-    file_obj.save()
+    try:
+        downloads.check_file_hash(request.GET['file_hash'])
+    except downloads.DownloadError as e:
+        return render(
+            request,
+            'client_app/outer_files.html',
+            {'files_list': [], 'error_text': str(e), **get_login_info()}
+        )
+    # the same content is already here, no need to load it again
+    os.makedirs(MEDIA_ROOT, exist_ok=True)
+    path = dedup.link_local_copy(request.GET['file_hash'], downloads.get_media_path(request.GET['name']))
+    if path:
+        downloads.register_media_file(path, request.GET['file_hash'])
+        return redirect('local_files')
+    queue_download(Transfer(ip=request.GET['ip'], name=request.GET['name'], file_hash=request.GET['file_hash']))
+    return redirect('transfers')
 
-    return redirect('local_files')
+
+class TransferView(LoginRequiredMixin, KeysetPaginationMixin, ListViewWithLoginInfo):
+    queryset = Transfer.objects.all()
+    ordering = ['-created', '-id']
+
+    def get_queryset(self):
+        # downloads of a crashed worker are shown as failed and can be retried
+        reset_stale_transfers()
+        return super().get_queryset()
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        # the page reloads itself while something is still loading
+        context['active'] = any(
+            transfer.status in (Transfer.QUEUED, Transfer.RUNNING) for transfer in context['object_list']
+        )
+        return context
+
+
+@login_required()
+def retry_transfer(request, transfer_id):
+    # the download resumes from its .part file
+    transfer = get_object_or_404(Transfer, id=transfer_id, status=Transfer.FAILED)
+    queue_download(transfer)
+    return redirect('transfers')
 
 
 @login_required()
@@ -0,0 +1,142 @@
+import logging
+import os
+import time
+from collections import defaultdict
+
+from django.db import close_old_connections
+
+from client.settings import WATCH_DEBOUNCE, WATCH_BATCH_SIZE, WATCH_STORAGE_REFRESH
+from client_app import inotify
+from client_app.models import Storage
+from client_app.scanner import get_nested_storage_paths, scan_storage
+from client_app.tasks import is_scan_pending, queue_storage_scan
+
+logger = logging.getLogger(__name__)
+
+_watch_mask = (
+    inotify.IN_CREATE | inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB | inotify.IN_MOVED_FROM
+    | inotify.IN_MOVED_TO | inotify.IN_DELETE | inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW | inotify.IN_EXCL_UNLINK
+)
+
+
+def collapse_paths(paths):
+    # a directory covers everything below it
+    collapsed = []
+    for path in sorted(paths):
+        if not collapsed or not path.startswith(os.path.join(collapsed[-1], '')):
+            collapsed.append(path)
+    return collapsed
+
+
+class StorageWatcher:
+    def __init__(self, debounce=WATCH_DEBOUNCE):
+        self.debounce = debounce
+        self.inotify = inotify.Inotify()
+        # wd -> watched directory
+        self.watches = {}
+        self.storages = []
+        # path -> time of its last event
+        self.dirty = {}
+        self.synced = 0
+
+    def watch_tree(self, root):
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                self.watches[self.inotify.add_watch(directory, _watch_mask)] = directory
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                # out of watches (fs.inotify.max_user_watches) or gone, full scans still cover it
+                logger.warning('Cannot watch %s: %s', directory, e)
+                continue
+            stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+
+    def unwatch_tree(self, root):
+        prefix = os.path.join(root, '')
+        for wd, directory in list(self.watches.items()):
+            if directory == root or directory.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def sync_storages(self):
+        # picks up storages added, removed, hidden or shown since the last check
+        close_old_connections()
+        storages = list(Storage.objects.filter(hidden=False))
+        paths = {storage.path for storage in storages}
+        for storage in self.storages:
+            if storage.path not in paths:
+                self.unwatch_tree(storage.path)
+        watched = {storage.path for storage in self.storages}
+        for storage in storages:
+            if storage.path not in watched:
+                self.watch_tree(storage.path)
+                # changes made while nobody was watching
+                queue_storage_scan(storage)
+        self.storages = storages
+        self.synced = time.monotonic()
+
+    def get_storage(self, path):
+        # nested storages own their files and their root directory
+        owners = [
+            storage for storage in self.storages
+            if path == storage.path.rstrip(os.sep) or path.startswith(os.path.join(storage.path, ''))
+        ]
+        return max(owners, key=lambda storage: len(storage.path.rstrip(os.sep)), default=None)
+
+    def handle(self, event):
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            # events were lost, only a full scan can tell what changed
+            logger.warning('Too many filesystem events, rescanning all storages')
+            for storage in self.storages:
+                queue_storage_scan(storage)
+            return
+        directory = self.watches.get(event.wd)
+        if directory is None:
+            return
+        if event.mask & inotify.IN_IGNORED:
+            del self.watches[event.wd]
+            return
+        path = os.path.join(directory, event.name) if event.name else directory
+        if event.mask & inotify.IN_ISDIR:
+            if event.mask & inotify.IN_MOVED_FROM:
+                self.unwatch_tree(path)
+            elif event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.watch_tree(path)
+        self.dirty[path] = time.monotonic()
+
+    def flush(self):
+        now = time.monotonic()
+        # files still being written are left for later
+        ready = [path for path, changed in self.dirty.items() if now - changed >= self.debounce]
+        if not ready:
+            return
+        for path in ready:
+            del self.dirty[path]
+        by_storage = defaultdict(list)
+        for path in collapse_paths(ready):
+            storage = self.get_storage(path)
+            if storage is not None:
+                by_storage[storage].append(path)
+        close_old_connections()
+        for storage, paths in by_storage.items():
+            if is_scan_pending(storage):
+                # both scans would add the same new files, the paths wait until the full scan is over
+                for path in paths:
+                    self.dirty.setdefault(path, now)
+                continue
+            skip_dirs = get_nested_storage_paths(storage, self.storages)
+            for start in range(0, len(paths), WATCH_BATCH_SIZE):
+                scan_storage(storage, skip_dirs, paths=paths[start:start + WATCH_BATCH_SIZE])
+
+    def run(self):
+        self.sync_storages()
+        last_flush = time.monotonic()
+        while True:
+            for event in self.inotify.read(timeout=self.debounce):
+                self.handle(event)
+            if time.monotonic() - last_flush >= self.debounce / 2:
+                self.flush()
+                last_flush = time.monotonic()
+            if time.monotonic() - self.synced >= WATCH_STORAGE_REFRESH:
+                self.sync_storages()